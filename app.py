@@ -1,14 +1,41 @@
 import os
+import io
+import gzip
+import csv
 import json
-from flask import Flask, render_template, request, jsonify, url_for, session
+import logging
+import math
+import struct
+import bisect
+import click # Ships with Flask; used for the CLI commands below
+from flask import Flask, render_template, request, jsonify, url_for, session, send_file, abort, redirect, Response, g
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image, ImageDraw # Installed with matplotlib; used for PNG encoding
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import cartopy.io.shapereader as shpreader
-from shapely.geometry import Point, MultiPolygon, Polygon
-import shutil # For clearing static directory
+import shapely
+from shapely.geometry import box, mapping
+from shapely.strtree import STRtree
+import hashlib # For content-addressed render cache filenames
+import threading # For guarding shared cache state across request threads
+import time
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.managers import BaseManager # For the render server shared by web workers
+from collections import OrderedDict # For LRU ordering in the render cache
 import numpy as np # For numerical operations in coordinate conversion
 
+try:
+    import brotli # Optional: enables brotli-precompressed vector assets
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 # Set a secret key for session management.
 # IMPORTANT: In a real application, this should be a strong, random key
@@ -27,262 +54,1824 @@ if not os.path.exists(TEMPLATES_FOLDER):
 
 app.template_folder = TEMPLATES_FOLDER
 
-# Geopolitical data (kept the same as previous versions)
-geopolitical_data = {
-    # North America
-    "USA": {"name": "United States", "allies": ["CAN", "GBR", "AUS", "JPN", "KOR", "DEU", "FRA", "MEX", "COL", "CHL"], "enemies": ["PRK", "IRN", "RUS", "CHN", "VEN", "CUB"]},
-    "CAN": {"name": "Canada", "allies": ["USA", "GBR", "AUS", "JPN", "KOR", "DEU", "FRA"], "enemies": []},
-    "MEX": {"name": "Mexico", "allies": ["USA", "CAN", "BRA", "COL"], "enemies": []},
-    "CUB": {"name": "Cuba", "allies": ["RUS", "CHN", "VEN", "PRK"], "enemies": ["USA"]},
-    # South America
-    "BRA": {"name": "Brazil", "allies": ["ARG", "MEX", "ZAF", "IND", "CHN", "RUS"], "enemies": []}, # BRICS
-    "ARG": {"name": "Argentina", "allies": ["BRA", "CHL", "USA"], "enemies": []},
-    "COL": {"name": "Colombia", "allies": ["USA", "PAN", "CHL"], "enemies": ["VEN"]},
-    "CHL": {"name": "Chile", "allies": ["USA", "ARG", "BRA"], "enemies": []},
-    "VEN": {"name": "Venezuela", "allies": ["CUB", "RUS", "CHN", "IRN"], "enemies": ["USA", "COL"]},
-    # Europe
-    "GBR": {"name": "United Kingdom", "allies": ["USA", "CAN", "AUS", "DEU", "FRA", "ITA", "ESP"], "enemies": []},
-    "DEU": {"name": "Germany", "allies": ["FRA", "USA", "GBR", "ITA", "ESP", "POL"], "enemies": ["RUS"]},
-    "FRA": {"name": "France", "allies": ["DEU", "USA", "GBR", "ITA", "ESP", "IND"], "enemies": []},
-    "ITA": {"name": "Italy", "allies": ["DEU", "FRA", "USA"], "enemies": []},
-    "ESP": {"name": "Spain", "allies": ["FRA", "DEU", "USA"], "enemies": []},
-    "POL": {"name": "Poland", "allies": ["USA", "DEU", "UKR"], "enemies": ["RUS", "BLR"]},
-    "UKR": {"name": "Ukraine", "allies": ["USA", "GBR", "DEU", "FRA", "POL"], "enemies": ["RUS"]},
-    "RUS": {"name": "Russian Federation", "allies": ["CHN", "BLR", "IRN", "PRK", "SYR"], "enemies": ["USA", "UKR", "DEU", "GBR", "FRA", "POL"]},
-    "BLR": {"name": "Belarus", "allies": ["RUS"], "enemies": ["POL", "UKR"]},
-    "GRC": {"name": "Greece", "allies": ["CYP", "USA", "FRA", "DEU"], "enemies": ["TUR"]},
-    "CYP": {"name": "Cyprus", "allies": ["GRC", "FRA", "ISR", "EGY"], "enemies": ["TUR"]},
-    "TUR": {"name": "Turkey", "allies": ["AZE", "QAT", "SOM", "UKR"], "enemies": ["GRC", "CYP", "ARM", "SYR", "SAU", "ARE"]}, # Added specific rivals
-    "ARM": {"name": "Armenia", "allies": ["RUS", "FRA", "GRC"], "enemies": ["AZE", "TUR"]},
-    "AZE": {"name": "Azerbaijan", "allies": ["TUR", "ISR", "PAK"], "enemies": ["ARM", "IRN"]},
-    "SWE": {"name": "Sweden", "allies": ["FIN", "NOR", "DNK"], "enemies": []},
-    "FIN": {"name": "Finland", "allies": ["SWE", "NOR", "DNK"], "enemies": ["RUS"]},
-    "NOR": {"name": "Norway", "allies": ["SWE", "FIN", "DNK"], "enemies": []},
-    "DNK": {"name": "Denmark", "allies": ["SWE", "FIN", "NOR"], "enemies": []},
-    "CHE": {"name": "Switzerland", "allies": [], "enemies": []}, # Neutral
-    "AUT": {"name": "Austria", "allies": [], "enemies": []}, # EU, but traditionally neutral
-    "NLD": {"name": "Netherlands", "allies": ["DEU", "GBR", "USA"], "enemies": []},
-    "BEL": {"name": "Belgium", "allies": ["DEU", "FRA", "NLD"], "enemies": []},
-    "PRT": {"name": "Portugal", "allies": ["USA", "GBR"], "enemies": []},
-    "IRL": {"name": "Ireland", "allies": ["GBR"], "enemies": []},
-    "LUX": {"name": "Luxembourg", "allies": ["BEL", "FRA", "DEU"], "enemies": []},
-    "MLT": {"name": "Malta", "allies": [], "enemies": []},
-    "ISL": {"name": "Iceland", "allies": ["USA", "NOR"], "enemies": []},
-    "GEO": {"name": "Georgia", "allies": ["USA", "UKR"], "enemies": ["RUS"]},
-    "MDA": {"name": "Moldova", "allies": ["ROU", "UKR"], "enemies": ["RUS"]},
-    "ROU": {"name": "Romania", "allies": ["USA", "DEU"], "enemies": []},
-    "SVK": {"name": "Slovakia", "allies": ["CZE", "DEU"], "enemies": []},
-    "CZE": {"name": "Czechia", "allies": ["SVK", "DEU"], "enemies": []},
-    "HUN": {"name": "Hungary", "allies": [], "enemies": []},
-    "BGR": {"name": "Bulgaria", "allies": [], "enemies": []},
-    "HRV": {"name": "Croatia", "allies": [], "enemies": []},
-    "SVN": {"name": "Slovenia", "allies": [], "enemies": []},
-    "SRB": {"name": "Serbia", "allies": ["RUS", "CHN"], "enemies": ["KOS", "ALB"]},
-    "KOS": {"name": "Kosovo", "allies": ["USA", "ALB", "DEU"], "enemies": ["SRB"]},
-    "ALB": {"name": "Albania", "allies": ["USA", "KOS"], "enemies": ["SRB"]},
-    "BIH": {"name": "Bosnia and Herzegovina", "allies": [], "enemies": ["SRB"]},
-    "MNE": {"name": "Montenegro", "allies": [], "enemies": []},
-    "MKD": {"name": "North Macedonia", "allies": [], "enemies": []},
-    "EST": {"name": "Estonia", "allies": ["USA", "FIN", "LVA", "LTU"], "enemies": ["RUS"]},
-    "LVA": {"name": "Latvia", "allies": ["USA", "EST", "LTU"], "enemies": ["RUS"]},
-    "LTU": {"name": "Lithuania", "allies": ["USA", "EST", "LVA"], "enemies": ["RUS"]},
-    # Middle East & North Africa
-    "ISR": {"name": "Israel", "allies": ["USA", "IND", "ARE", "BHR", "MAR", "SDN"], "enemies": ["IRN", "LBN", "PSE", "SYR"]},
-    "IRN": {"name": "Iran", "allies": ["RUS", "CHN", "SYR", "PRK"], "enemies": ["USA", "ISR", "SAU", "ARE", "AZE"]},
-    "SAU": {"name": "Saudi Arabia", "allies": ["USA", "GBR", "ARE", "BHR", "EGY", "PAK", "QAT"], "enemies": ["IRN"]},
-    "ARE": {"name": "United Arab Emirates", "allies": ["USA", "SAU", "ISR"], "enemies": ["IRN", "QAT"]},
-    "QAT": {"name": "Qatar", "allies": ["USA", "TUR", "IRN"], "enemies": ["SAU", "ARE", "BHR", "EGY"]},
-    "SYR": {"name": "Syria", "allies": ["RUS", "IRN"], "enemies": ["ISR", "TUR", "USA"]},
-    "EGY": {"name": "Egypt", "allies": ["USA", "SAU", "ARE", "JOR", "ISR"], "enemies": []},
-    "PAK": {"name": "Pakistan", "allies": ["CHN", "TUR", "SAU"], "enemies": ["IND", "AFG"]},
-    "AFG": {"name": "Afghanistan", "allies": ["CHN", "PAK"], "enemies": ["PAK"]},
-    "LBN": {"name": "Lebanon", "allies": ["FRA"], "enemies": ["ISR", "SYR"]},
-    "JOR": {"name": "Jordan", "allies": ["USA", "GBR", "SAU", "EGY"], "enemies": []},
-    "IRQ": {"name": "Iraq", "allies": ["USA", "IRN"], "enemies": ["ISIS", "TUR"]},
-    "DZA": {"name": "Algeria", "allies": ["RUS", "CHN"], "enemies": ["MAR"]},
-    "MAR": {"name": "Morocco", "allies": ["USA", "FRA", "ISR"], "enemies": ["DZA"]},
-    "KWT": {"name": "Kuwait", "allies": ["USA", "SAU"], "enemies": ["IRN"]},
-    "OMN": {"name": "Oman", "allies": ["GBR", "USA"], "enemies": []},
-    "BHR": {"name": "Bahrain", "allies": ["USA", "SAU", "ARE", "ISR"], "enemies": ["IRN"]},
-    "YEM": {"name": "Yemen", "allies": ["SAU"], "enemies": ["IRN"]},
-    "SDN": {"name": "Sudan", "allies": ["EGY", "SAU", "ARE"], "enemies": []},
-    "LBY": {"name": "Libya", "allies": ["TUR"], "enemies": ["EGY", "RUS"]},
-    "TUN": {"name": "Tunisia", "allies": ["FRA"], "enemies": []},
-    "MRT": {"name": "Mauritania", "allies": ["FRA"], "enemies": []},
-
-    # Asia-Pacific
-    "CHN": {"name": "China", "allies": ["RUS", "PRK", "PAK", "IRN", "LAO", "KHM"], "enemies": ["USA", "IND", "JPN", "KOR", "TWN", "AUS", "PHL", "VNM"]},
-    "IND": {"name": "India", "allies": ["USA", "RUS", "FRA", "JPN", "AUS", "ISR"], "enemies": ["PAK", "CHN"]},
-    "JPN": {"name": "Japan", "allies": ["USA", "AUS", "IND", "KOR"], "enemies": ["CHN", "PRK", "RUS"]},
-    "KOR": {"name": "South Korea", "allies": ["USA", "JPN"], "enemies": ["PRK", "CHN"]},
-    "PRK": {"name": "North Korea", "allies": ["CHN", "RUS", "IRN"], "enemies": ["USA", "KOR", "JPN"]},
-    "AUS": {"name": "Australia", "allies": ["USA", "GBR", "JPN", "IND", "NZL"], "enemies": ["CHN"]},
-    "NZL": {"name": "New Zealand", "allies": ["AUS", "USA", "GBR"], "enemies": []},
-    "PHL": {"name": "Philippines", "allies": ["USA", "JPN", "AUS"], "enemies": ["CHN"]},
-    "VNM": {"name": "Vietnam", "allies": ["USA", "RUS"], "enemies": ["CHN"]},
-    "IDN": {"name": "Indonesia", "allies": ["AUS", "MYS", "SGP"], "enemies": []},
-    "MYS": {"name": "Malaysia", "allies": ["IDN", "SGP", "GBR"], "enemies": []},
-    "SGP": {"name": "Singapore", "allies": ["IDN", "MYS", "USA"], "enemies": []},
-    "THA": {"name": "Thailand", "allies": ["USA", "JPN"], "enemies": []},
-    "LAO": {"name": "Laos", "allies": ["CHN", "VNM"], "enemies": []},
-    "KHM": {"name": "Cambodia", "allies": ["CHN", "VNM"], "enemies": []},
-    "TWN": {"name": "Taiwan", "allies": ["USA", "JPN"], "enemies": ["CHN"]},
-    "KAZ": {"name": "Kazakhstan", "allies": ["RUS", "CHN"], "enemies": []},
-    "UZB": {"name": "Uzbekistan", "allies": ["RUS", "CHN"], "enemies": []},
-    "TKM": {"name": "Turkmenistan", "allies": [], "enemies": []},
-    "KGZ": {"name": "Kyrgyzstan", "allies": ["RUS", "CHN"], "enemies": []},
-    "TJK": {"name": "Tajikistan", "allies": ["RUS", "CHN"], "enemies": []},
-    "LKA": {"name": "Sri Lanka", "allies": ["IND", "CHN"], "enemies": []},
-    "MDV": {"name": "Maldives", "allies": ["IND", "CHN"], "enemies": []},
-    "BGD": {"name": "Bangladesh", "allies": ["IND", "CHN"], "enemies": []},
-    "NPL": {"name": "Nepal", "allies": ["IND", "CHN"], "enemies": []},
-    "BTN": {"name": "Bhutan", "allies": ["IND"], "enemies": []},
-    "MMR": {"name": "Myanmar", "allies": ["CHN", "RUS"], "enemies": []},
-    "PNG": {"name": "Papua New Guinea", "allies": ["AUS", "USA"], "enemies": []},
-    "FJI": {"name": "Fiji", "allies": ["AUS", "NZL"], "enemies": []},
-    "KIR": {"name": "Kiribati", "allies": ["AUS", "NZL"], "enemies": []},
-    "SLB": {"name": "Solomon Islands", "allies": ["AUS", "CHN"], "enemies": ["CHN"]},
-    "VUT": {"name": "Vanuatu", "allies": ["AUS", "NZL"], "enemies": []},
-    "WSM": {"name": "Samoa", "allies": ["AUS", "NZL"], "enemies": []},
-    "TUV": {"name": "Tuvalu", "allies": ["AUS", "NZL"], "enemies": []},
-    "MHL": {"name": "Marshall Islands", "allies": ["USA"], "enemies": []},
-    "FSM": {"name": "Micronesia (Federated States of)", "allies": ["USA"], "enemies": []},
-    "PLW": {"name": "Palau", "allies": ["USA"], "enemies": []},
-
-    # Africa
-    "ZAF": {"name": "South Africa", "allies": ["BRA", "IND", "CHN", "RUS"], "enemies": []},
-    "NGA": {"name": "Nigeria", "allies": ["USA", "GBR", "FRA"], "enemies": []},
-    "ETH": {"name": "Ethiopia", "allies": ["CHN", "RUS"], "enemies": ["ERI", "SOM"]},
-    "ERI": {"name": "Eritrea", "allies": [], "enemies": ["ETH"]},
-    "KEN": {"name": "Kenya", "allies": ["USA", "GBR"], "enemies": ["SOM"]},
-    "SOM": {"name": "Somalia", "allies": ["TUR", "QAT", "ETH"], "enemies": ["ETH", "KEN"]},
-    "MLI": {"name": "Mali", "allies": ["RUS"], "enemies": ["FRA"]},
-    "NER": {"name": "Niger", "allies": ["RUS"], "enemies": ["FRA"]},
-    "BFA": {"name": "Burkina Faso", "allies": ["RUS"], "enemies": ["FRA"]},
-    "CIV": {"name": "Cote d'Ivoire", "allies": ["FRA"], "enemies": []},
-    "GHA": {"name": "Ghana", "allies": ["GBR", "USA"], "enemies": []},
-    "CMR": {"name": "Cameroon", "allies": ["FRA"], "enemies": []},
-    "GAB": {"name": "Gabon", "allies": ["FRA"], "enemies": []},
-    "COD": {"name": "Dem. Rep. Congo", "allies": ["BEL", "USA"], "enemies": ["RWA"]},
-    "RWA": {"name": "Rwanda", "allies": ["GBR", "USA"], "enemies": ["COD"]},
-    "UGA": {"name": "Uganda", "allies": ["USA"], "enemies": []},
-    "TZA": {"name": "Tanzania", "allies": ["CHN"], "enemies": []},
-    "MOZ": {"name": "Mozambique", "allies": ["CHN"], "enemies": []},
-    "MDG": {"name": "Madagascar", "allies": ["FRA"], "enemies": []},
-    "COM": {"name": "Comoros", "allies": ["FRA"], "enemies": []},
-    "SYC": {"name": "Seychelles", "allies": ["IND"], "enemies": []},
-    "MUS": {"name": "Mauritius", "allies": ["IND"], "enemies": []},
-    "NAM": {"name": "Namibia", "allies": ["CHN"], "enemies": []},
-    "BWA": {"name": "Botswana", "allies": ["ZAF"], "enemies": []},
-    "AGO": {"name": "Angola", "allies": ["CHN"], "enemies": []},
-    "GMB": {"name": "Gambia", "allies": ["GBR"], "enemies": []},
-    "SEN": {"name": "Senegal", "allies": ["FRA"], "enemies": []},
-    "GNB": {"name": "Guinea-Bissau", "allies": ["PRT"], "enemies": []},
-    "GIN": {"name": "Guinea", "allies": ["CHN"], "enemies": []},
-    "SLE": {"name": "Sierra Leone", "allies": ["GBR"], "enemies": []},
-    "LBR": {"name": "Liberia", "allies": ["USA"], "enemies": []},
-    "COG": {"name": "Republic of the Congo", "allies": ["FRA"], "enemies": []},
-    "CAF": {"name": "Central African Republic", "allies": ["RUS"], "enemies": ["FRA"]},
-    "SSD": {"name": "South Sudan", "allies": ["USA"], "enemies": ["SDN"]},
-
-    # Default fallback for countries not explicitly listed
-    "DEFAULT": {"name": "Unknown Country", "allies": [], "enemies": []}
-}
+# Structured, leveled logging. LOG_LEVEL (DEBUG, INFO, WARNING, ...) selects what is written to
+# stderr; per-request details are logged at DEBUG so they cost nothing at the default INFO level.
+# LOG_FORMAT=json writes one JSON object per line, including any fields passed via `extra`.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as text with key=value fields appended, or as single-line JSON."""
+
+    def __init__(self, as_json=False):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items() if key not in _LOG_RECORD_FIELDS}
+        if self.as_json:
+            entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                     "message": record.getMessage(), **fields}
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        text = super().format(record)
+        if fields:
+            text += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+logger = logging.getLogger('geomap')
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(StructuredFormatter(as_json=LOG_FORMAT == 'json'))
+logger.addHandler(_log_handler)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+# Geopolitical relations are loaded from an external JSON (or CSV) file so they can be updated
+# without a redeploy; running workers pick up changes via reload_relations(). JSON files map ISO
+# codes to {"name", "allies", "enemies"}; CSV files have iso,name,allies,enemies columns with
+# relation codes separated by semicolons. The "DEFAULT" entry is the fallback for unlisted countries.
+RELATIONS_DATA_PATH = os.environ.get('RELATIONS_DATA_PATH', os.path.join(os.path.dirname(__file__), 'data', 'geopolitical_data.json'))
+RELATIONS_RELOAD_INTERVAL = float(os.environ.get('RELATIONS_RELOAD_INTERVAL', 5)) # Seconds between file checks
+
+def validate_relations(data, path):
+    """Raises ValueError unless data maps codes to entries with a string name and lists of string codes."""
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: expected an object mapping ISO codes to entries, got {type(data).__name__}")
+    for iso, info in data.items():
+        if not isinstance(info, dict):
+            raise ValueError(f"{path}: entry {iso} must be an object, got {type(info).__name__}")
+        if not isinstance(info.get('name', ''), str):
+            raise ValueError(f"{path}: name of {iso} must be a string")
+        for key in ('allies', 'enemies'):
+            codes = info.get(key, [])
+            # A bare string would otherwise be iterated character by character
+            if not isinstance(codes, list) or not all(isinstance(code, str) for code in codes):
+                raise ValueError(f"{path}: {key} of {iso} must be a list of ISO code strings")
+
+def read_relations_file(path):
+    """Reads a relations dataset from a JSON or CSV file into the geopolitical_data layout."""
+    if path.lower().endswith('.csv'):
+        data = {}
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                if not (row.get('iso') or '').strip():
+                    raise ValueError(f"{path}: row {row} has no iso code")
+                iso = row['iso'].strip()
+                data[iso] = {
+                    "name": (row.get('name') or '').strip() or iso,
+                    "allies": [code.strip() for code in (row.get('allies') or '').split(';') if code.strip()],
+                    "enemies": [code.strip() for code in (row.get('enemies') or '').split(';') if code.strip()],
+                }
+    else:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    validate_relations(data, path)
+    data.setdefault("DEFAULT", {"name": "Unknown Country", "allies": [], "enemies": []})
+    return data
+
+geopolitical_data = read_relations_file(RELATIONS_DATA_PATH)
+
+class RelationGraph:
+    """
+    Compiled index over geopolitical_data. Every country code (including codes only referenced
+    in relation lists) gets an integer ID; ally and enemy edges are stored both as frozensets of
+    codes and as integer bitsets, alongside reverse edges ("who lists X as an ally/enemy") and
+    precomputed display names. Problems in the source data are collected in `issues`; with
+    known_codes (the ISO codes that have country shapes) codes that can never be drawn or
+    clicked are reported too.
+    """
+
+    def __init__(self, data, known_codes=None):
+        self.default = data.get("DEFAULT", {"name": "Unknown Country", "allies": [], "enemies": []})
+        entries = {iso: info for iso, info in data.items() if iso != "DEFAULT"}
+        self.issues = []
+
+        # Assign IDs: listed countries first, then codes that only appear in relation lists
+        codes = list(entries.keys())
+        for iso, info in entries.items():
+            for code in list(info.get('allies', [])) + list(info.get('enemies', [])):
+                if code not in entries and code not in codes:
+                    codes.append(code)
+                    self.issues.append(f"{code} is referenced (first by {iso}) but has no entry")
+        self.codes = codes
+        self.ids = {code: index for index, code in enumerate(codes)}
+        if known_codes is not None:
+            for code in codes:
+                if code not in known_codes:
+                    self.issues.append(f"{code} has no country shape, so it is never drawn or clickable")
+        self.names = {code: entries.get(code, {}).get('name', code) for code in codes}
+
+        self.allies = {}
+        self.enemies = {}
+        allied_by = {code: set() for code in codes}
+        opposed_by = {code: set() for code in codes}
+        for iso, info in entries.items():
+            allies = list(info.get('allies', []))
+            enemies = list(info.get('enemies', []))
+            if len(set(allies)) != len(allies) or len(set(enemies)) != len(enemies):
+                self.issues.append(f"{iso} lists the same country more than once")
+            if iso in allies or iso in enemies:
+                self.issues.append(f"{iso} lists itself as an ally or enemy")
+            for code in sorted(set(allies) & set(enemies)):
+                self.issues.append(f"{iso} lists {code} as both an ally and an enemy")
+            # Keep the source order (minus duplicates) for display
+            self.allies[iso] = tuple(dict.fromkeys(allies))
+            self.enemies[iso] = tuple(dict.fromkeys(enemies))
+            for code in allies:
+                allied_by[code].add(iso)
+            for code in enemies:
+                opposed_by[code].add(iso)
+
+        self.ally_sets = {iso: frozenset(allies) for iso, allies in self.allies.items()}
+        self.enemy_sets = {iso: frozenset(enemies) for iso, enemies in self.enemies.items()}
+        self.allied_by = {code: frozenset(isos) for code, isos in allied_by.items()}
+        self.opposed_by = {code: frozenset(isos) for code, isos in opposed_by.items()}
+        self.ally_bits = {iso: self._to_bits(allies) for iso, allies in self.allies.items()}
+        self.enemy_bits = {iso: self._to_bits(enemies) for iso, enemies in self.enemies.items()}
+        self.ally_names = {iso: tuple(self.names[code] for code in allies) for iso, allies in self.allies.items()}
+        self.enemy_names = {iso: tuple(self.names[code] for code in enemies) for iso, enemies in self.enemies.items()}
+
+        # Per-country data versions (a short hash of the country's relations) are embedded in render
+        # cache keys, so a data change only invalidates images of the countries whose relations changed
+        self.versions = {
+            iso: hashlib.sha1(json.dumps([sorted(self.allies[iso]), sorted(self.enemies[iso])]).encode('utf-8')).hexdigest()[:12]
+            for iso in entries
+        }
+        self.version = hashlib.sha1(json.dumps(sorted(self.versions.items())).encode('utf-8')).hexdigest()[:12]
+
+    def _to_bits(self, codes):
+        bits = 0
+        for code in codes:
+            bits |= 1 << self.ids[code]
+        return bits
+
+    def _from_bits(self, bits):
+        codes = []
+        while bits:
+            lowest = bits & -bits
+            codes.append(self.codes[lowest.bit_length() - 1])
+            bits ^= lowest
+        return frozenset(codes)
+
+    def name(self, iso):
+        return self.names.get(iso, iso)
+
+    def country_version(self, iso):
+        """Data version of a country's relations; countries without an entry share the default version."""
+        return self.versions.get(iso, "default")
+
+    def changed_countries(self, previous):
+        """Countries whose relations differ between this graph and a previous one (including added/removed entries)."""
+        return {iso for iso in set(self.versions) | set(previous.versions)
+                if self.versions.get(iso) != previous.versions.get(iso)}
+
+    def relations(self, iso):
+        """Returns (allies, enemies) ISO tuples for a country, empty for countries without an entry."""
+        return self.allies.get(iso, ()), self.enemies.get(iso, ())
+
+    def relation_names(self, iso):
+        """Returns (ally names, enemy names) tuples for a country."""
+        return self.ally_names.get(iso, ()), self.enemy_names.get(iso, ())
+
+    def allies_of_allies(self, iso):
+        """Countries allied to iso's allies, excluding iso itself and its direct allies."""
+        bits = 0
+        for ally in self.allies.get(iso, ()):
+            bits |= self.ally_bits.get(ally, 0)
+        bits &= ~self.ally_bits.get(iso, 0)
+        if iso in self.ids:
+            bits &= ~(1 << self.ids[iso])
+        return self._from_bits(bits)
+
+    def shortest_relation_path(self, source, target, relations=('allies', 'enemies')):
+        """
+        Breadth-first search along the given relation types from source to target, in time
+        linear in the number of relation edges. Returns the list of codes on the path, or None.
+        """
+        if source == target:
+            return [source]
+        adjacency = [getattr(self, name) for name in relations]
+        previous = {source: None}
+        queue = deque([source])
+        while queue:
+            code = queue.popleft()
+            for edges in adjacency:
+                for neighbour in edges.get(code, ()):
+                    if neighbour in previous:
+                        continue
+                    previous[neighbour] = code
+                    if neighbour == target:
+                        path = [neighbour]
+                        while previous[path[-1]] is not None:
+                            path.append(previous[path[-1]])
+                        return path[::-1]
+                    queue.append(neighbour)
+        return None
+
 
 # Pre-load country geometries once on app startup to avoid reloading for every click
 _country_geometries = {}
+# Spatial index over _country_geometries for click hit testing, built once after loading.
+# _country_tree_isos[i] is the ISO code of the i-th geometry in the tree (in dict order).
+_country_tree = None
+_country_tree_isos = np.array([], dtype=object)
+
+def build_country_index():
+    """Builds the STRtree spatial index over the loaded country geometries."""
+    global _country_tree, _country_tree_isos
+    isos = list(_country_geometries.keys())
+    _country_tree_isos = np.array(isos, dtype=object)
+    _country_tree = STRtree([_country_geometries[iso]['geometry'] for iso in isos])
+
+# Pre-baked geometry bundles let workers start without downloading or parsing shapefiles.
+# A bundle is a single file: an 8-byte magic, a little-endian uint32 header length, a JSON
+# header listing each country's ISO code, name, precomputed bounds and the offset/length of
+# its WKB, followed by the concatenated WKB blobs. Build one with `flask build-geometry-bundle`.
+GEOMETRY_BUNDLE_FOLDER = os.environ.get('GEOMETRY_BUNDLE_FOLDER', os.path.join(os.path.dirname(__file__), 'data'))
+GEOMETRY_BUNDLE_MAGIC = b'GEOBNDL1'
+# Production workers should never download or parse shapefiles at boot; with
+# REQUIRE_GEOMETRY_BUNDLE=1 a missing 110m bundle stops the app instead (see the Procfile).
+REQUIRE_GEOMETRY_BUNDLE = os.environ.get('REQUIRE_GEOMETRY_BUNDLE', '0') == '1'
+
+def geometry_bundle_path(resolution='110m'):
+    return os.path.join(GEOMETRY_BUNDLE_FOLDER, f'admin_0_countries_{resolution}.geobundle')
+
+def read_natural_earth_countries(resolution='110m'):
+    """
+    Reads country records from the Natural Earth admin_0 shapefile (downloading it on first use).
+    Returns a list of (iso_a3, name, geometry, bounds) tuples in shapefile order.
+    """
+    shpfilename = shpreader.natural_earth(resolution=resolution,
+                                          category='cultural',
+                                          name='admin_0_countries')
+    reader = shpreader.Reader(shpfilename)
+    return [(record.attributes['ISO_A3'], record.attributes['NAME'], record.geometry, record.geometry.bounds)
+            for record in reader.records()]
+
+def write_geometry_bundle(path, countries):
+    """Writes (iso_a3, name, geometry, bounds) records to a geometry bundle file."""
+    wkbs = shapely.to_wkb([geometry for _, _, geometry, _ in countries])
+    entries = []
+    offset = 0
+    for (iso_a3, name, _, bounds), wkb in zip(countries, wkbs):
+        entries.append({"iso": iso_a3, "name": name, "bounds": list(bounds), "offset": offset, "length": len(wkb)})
+        offset += len(wkb)
+    header = json.dumps({"version": 1, "countries": entries}, separators=(',', ':')).encode('utf-8')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(GEOMETRY_BUNDLE_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for wkb in wkbs:
+            f.write(wkb)
+    os.replace(tmp_path, path)
+
+def read_geometry_bundle(path):
+    """
+    Reads a geometry bundle and decodes all geometries in one vectorized call.
+    Returns a list of (iso_a3, name, geometry, bounds) tuples in bundle order.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(GEOMETRY_BUNDLE_MAGIC)] != GEOMETRY_BUNDLE_MAGIC:
+        raise ValueError(f"{path} is not a geometry bundle")
+    header_start = len(GEOMETRY_BUNDLE_MAGIC) + 4
+    (header_length,) = struct.unpack_from('<I', data, len(GEOMETRY_BUNDLE_MAGIC))
+    header = json.loads(data[header_start:header_start + header_length])
+    data_start = header_start + header_length
+    entries = header["countries"]
+    geometries = shapely.from_wkb([data[data_start + entry["offset"]:data_start + entry["offset"] + entry["length"]]
+                                   for entry in entries])
+    return [(entry["iso"], entry["name"], geometry, tuple(entry["bounds"]))
+            for entry, geometry in zip(entries, geometries)]
+
 def load_country_geometries():
-    """Loads country geometries from Natural Earth shapefile into memory."""
+    """
+    Loads country geometries into memory, from the pre-baked bundle if one exists
+    and from the Natural Earth shapefile otherwise.
+    """
     global _country_geometries # Declare as global to modify the module-level variable
+    bundle_path = geometry_bundle_path('110m')
+    if REQUIRE_GEOMETRY_BUNDLE and not os.path.exists(bundle_path):
+        raise RuntimeError(f"REQUIRE_GEOMETRY_BUNDLE is set but {bundle_path} does not exist; "
+                           "run `flask --app app build-geometry-bundle` first")
     try:
-        shpfilename = shpreader.natural_earth(resolution='110m',
-                                              category='cultural',
-                                              name='admin_0_countries')
-        reader = shpreader.Reader(shpfilename)
-        for record in reader.records():
-            _country_geometries[record.attributes['ISO_A3']] = {
-                'name': record.attributes['NAME'],
-                'geometry': record.geometry
+        if os.path.exists(bundle_path):
+            countries = read_geometry_bundle(bundle_path)
+            source = bundle_path
+        else:
+            countries = read_natural_earth_countries('110m')
+            source = "Natural Earth shapefile"
+        for iso_a3, name, geometry, bounds in countries:
+            _country_geometries[iso_a3] = {
+                'name': name,
+                'geometry': geometry,
+                'bounds': bounds
             }
-        print("Country geometries loaded successfully.")
+        build_country_index()
+        logger.info("Country geometries loaded successfully from %s.", source)
     except Exception as e:
-        print(f"Error loading country geometries: {e}")
+        logger.error("Error loading country geometries: %s", e)
 
 # Call this function once when the app starts
 load_country_geometries()
 
+def relation_known_codes():
+    """ISO codes with a country shape, to check relation data against (None if no shapes loaded)."""
+    return set(_country_geometries) or None
+
+# Compile the relation data once at startup and report any inconsistencies
+relation_graph = RelationGraph(geopolitical_data, relation_known_codes())
+for issue in relation_graph.issues:
+    logger.warning("Relation data warning: %s", issue)
+
+# Levels of detail. The 110m geometries above are always loaded; the more detailed Natural Earth
+# resolutions are loaded on first use when the view is narrow enough to need them, and only the
+# most recently used GEOMETRY_LEVEL_CACHE_SIZE of them are kept in memory.
+GEOMETRY_LEVELS = [
+    ("110m", 60), # (resolution, minimum extent width in degrees of longitude)
+    ("50m", 15),
+    ("10m", 0),
+]
+GEOMETRY_LEVEL_CACHE_SIZE = int(os.environ.get('GEOMETRY_LEVEL_CACHE_SIZE', 2)) # Both detailed levels by default
+_geometry_levels = OrderedDict() # resolution -> level dict, least recently used first
+_geometry_levels_loading = {} # resolution -> threading.Event set when its load finishes
+_geometry_levels_lock = threading.Lock()
+
+def resolution_for_extent(extent):
+    """Returns the Natural Earth resolution to use for an extent [lon_min, lon_max, lat_min, lat_max]."""
+    width = extent[1] - extent[0]
+    for resolution, min_width in GEOMETRY_LEVELS:
+        if width >= min_width:
+            return resolution
+    return GEOMETRY_LEVELS[-1][0]
+
+def load_geometry_level(resolution):
+    """Loads a detailed geometry level from its bundle if available, else from the shapefile."""
+    bundle_path = geometry_bundle_path(resolution)
+    if os.path.exists(bundle_path):
+        countries_list = read_geometry_bundle(bundle_path)
+    else:
+        countries_list = read_natural_earth_countries(resolution)
+    countries = {}
+    for iso_a3, name, geometry, bounds in countries_list:
+        countries[iso_a3] = {'name': name, 'geometry': geometry, 'bounds': bounds}
+    isos = list(countries.keys())
+    logger.info("Loaded %d country geometries at %s resolution.", len(countries), resolution)
+    return {
+        "resolution": resolution,
+        "countries": countries,
+        "isos": np.array(isos, dtype=object),
+        "tree": STRtree([countries[iso]['geometry'] for iso in isos]),
+    }
+
+def get_geometry_level(resolution='110m'):
+    """
+    Returns the level dict (countries, isos, tree) for a resolution, loading it lazily.
+    Falls back to the always-loaded 110m level if a detailed level cannot be loaded.
+    A level is loaded (possibly downloaded) outside the lock, so other levels stay available;
+    concurrent callers for the same level wait for that one load instead of repeating it.
+    """
+    base_level = {"resolution": "110m", "countries": _country_geometries,
+                  "isos": _country_tree_isos, "tree": _country_tree}
+    if resolution == "110m":
+        return base_level
+
+    with _geometry_levels_lock:
+        if resolution in _geometry_levels:
+            _geometry_levels.move_to_end(resolution)
+            return _geometry_levels[resolution]
+        loading = _geometry_levels_loading.get(resolution)
+        if loading is None:
+            _geometry_levels_loading[resolution] = threading.Event()
+
+    if loading is not None:
+        loading.wait()
+        with _geometry_levels_lock:
+            # The level is missing if its load failed (or it was evicted meanwhile)
+            return _geometry_levels.get(resolution, base_level)
+
+    level = None
+    try:
+        level = load_geometry_level(resolution)
+    except Exception as e:
+        logger.warning("Error loading %s geometries, using 110m: %s", resolution, e)
+    with _geometry_levels_lock:
+        if level is not None:
+            _geometry_levels[resolution] = level
+            while len(_geometry_levels) > GEOMETRY_LEVEL_CACHE_SIZE:
+                _geometry_levels.popitem(last=False)
+        _geometry_levels_loading.pop(resolution).set()
+    return level or base_level
+
+def visible_countries(extent, level=None, clip_margin=0.02):
+    """
+    Returns (iso_a3, geometry) pairs, in load order, for the countries intersecting the extent
+    at the extent's level of detail. Geometries are clipped to the extent, padded by
+    clip_margin of its size so the cut edges fall outside the visible axes.
+    """
+    if level is None:
+        level = get_geometry_level(resolution_for_extent(extent))
+    if level["tree"] is None:
+        return []
+
+    lon_min, lon_max, lat_min, lat_max = extent
+    pad_lon = (lon_max - lon_min) * clip_margin
+    pad_lat = (lat_max - lat_min) * clip_margin
+    clip_box = (lon_min - pad_lon, lat_min - pad_lat, lon_max + pad_lon, lat_max + pad_lat)
+
+    visible = []
+    for index in sorted(level["tree"].query(box(*clip_box))):
+        geometry = shapely.clip_by_rect(level["tree"].geometries[index], *clip_box)
+        if not geometry.is_empty:
+            visible.append((level["isos"][index], geometry))
+    return visible
+
+def find_countries_at(lons, lats, resolution='110m'):
+    """
+    Resolves many (lon, lat) points to the ISO code of the country containing each one
+    in a single vectorized STRtree query. Returns a list with None for points outside
+    every country (e.g. ocean). The tree prepares its geometries for the predicate, so
+    only bounding-box candidates are tested against the full polygons.
+    """
+    level = get_geometry_level(resolution)
+    lons = np.asarray(lons, dtype=float).ravel()
+    lats = np.asarray(lats, dtype=float).ravel()
+    result = np.full(lons.shape, None, dtype=object)
+    if level["tree"] is None or lons.size == 0:
+        return result.tolist()
+
+    points = shapely.points(lons, lats)
+    point_idx, geom_idx = level["tree"].query(points, predicate='within')
+    if point_idx.size:
+        # Where geometries overlap, keep the first one in dict order to match a linear scan
+        order = np.lexsort((geom_idx, point_idx))
+        point_idx, geom_idx = point_idx[order], geom_idx[order]
+        _, first = np.unique(point_idx, return_index=True)
+        result[point_idx[first]] = level["isos"][geom_idx[first]]
+    return result.tolist()
+
+def find_country_at(lon, lat, resolution='110m'):
+    """Returns the ISO code of the country containing (lon, lat), or None."""
+    return find_countries_at([lon], [lat], resolution)[0]
+
 # Define the default map extent
 DEFAULT_EXTENT = [-180, 180, -90, 90] # [lon_min, lon_max, lat_min, lat_max]
 ZOOM_FACTOR = 0.7 # Factor to zoom in/out (e.g., 0.7 means 70% of current view)
 MIN_ZOOM_WIDTH = 10 # Minimum longitude range for zoom in limit
 MIN_ZOOM_HEIGHT = 10 # Minimum latitude range for zoom in limit
 
+# Per-stage timing hooks. Render and lookup code wraps its stages in timed_stage(); listeners
+# registered with add_stage_listener (e.g. the benchmark suite) receive (stage, seconds).
+# With no listeners registered the overhead is a single perf_counter() call per stage.
+_stage_listeners = []
+
+def add_stage_listener(listener):
+    _stage_listeners.append(listener)
+
+def remove_stage_listener(listener):
+    if listener in _stage_listeners:
+        _stage_listeners.remove(listener)
+
+def record_stage(stage, seconds):
+    """Passes a stage timing to every listener (also used for timings measured in render workers)."""
+    for listener in list(_stage_listeners):
+        listener(stage, seconds)
+
+@contextmanager
+def timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _stage_listeners:
+            record_stage(stage, time.perf_counter() - started)
+
+def run_with_stage_timings(fn, *args):
+    """
+    Runs fn(*args) in a render worker process and returns (result, [(stage, seconds), ...]),
+    so stages timed inside the worker can be recorded by the web process.
+    """
+    timings = []
+    listener = lambda stage, seconds: timings.append((stage, seconds))
+    add_stage_listener(listener)
+    try:
+        return fn(*args), timings
+    finally:
+        remove_stage_listener(listener)
+
+# Prometheus metrics, exposed in the text exposition format at /metrics. Histograms and counters
+# are updated on the request path; cache, queue and disk figures are read when scraped. Metrics
+# are per process, so with several server workers each scrape reports the worker that served it.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_DISK_TTL = float(os.environ.get('METRICS_DISK_TTL', 60)) # Seconds a folder's file count is reused
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (4096, 16384, 32768, 65536, 131072, 262144, 524288, 1048576, 4194304)
+
+def format_metric_labels(labels):
+    """Formats a label dict as {name="value",...}, escaping values as Prometheus requires."""
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def metric_lines(name, help_text, metric_type, samples):
+    """Returns the exposition lines of a metric given (labels dict, value) samples."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    lines.extend(f"{name}{format_metric_labels(labels)} {value}" for labels, value in samples)
+    return lines
+
+class Counter:
+    """A monotonically increasing count per combination of label values."""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {} # label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        with self._lock:
+            samples = [(dict(zip(self.label_names, key)), value) for key, value in sorted(self._values.items())]
+        return metric_lines(self.name, self.help_text, 'counter', samples)
+
+class Histogram:
+    """Observations counted into fixed buckets per combination of label values, with sum and count."""
+
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._series = {} # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._series.items())
+        for key, (counts, total, count) in series:
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_metric_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_sum{format_metric_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_metric_labels(labels)} {count}")
+        return lines
+
+STAGE_SECONDS = Histogram('geomap_stage_seconds', 'Time spent in each render and lookup stage.', LATENCY_BUCKETS, ('stage',))
+MAP_IMAGE_BYTES = Histogram('geomap_map_image_bytes', 'Size of encoded map images.', SIZE_BUCKETS, ('format',))
+HTTP_REQUEST_SECONDS = Histogram('geomap_http_request_seconds', 'Time spent handling HTTP requests.', LATENCY_BUCKETS, ('endpoint',))
+HTTP_REQUESTS = Counter('geomap_http_requests_total', 'HTTP requests handled.', ('endpoint', 'status'))
+
+if METRICS_ENABLED:
+    add_stage_listener(lambda stage, seconds: STAGE_SECONDS.observe(seconds, stage=stage))
+
+# Country fill colors shared by the full and layered renderers
+DEFAULT_COUNTRY_COLOR = '#cbd5e0' # Default grey
+SELECTED_COUNTRY_COLOR = 'orange'
+ALLY_COUNTRY_COLOR = 'green'
+ENEMY_COUNTRY_COLOR = 'red'
+
+def country_facecolor(iso_a3, selected_iso=None, allies_iso_list=(), enemies_iso_list=()):
+    """Returns the fill color of a country given the current selection and its relations."""
+    if selected_iso and iso_a3 == selected_iso:
+        return SELECTED_COUNTRY_COLOR
+    elif iso_a3 in allies_iso_list:
+        return ALLY_COUNTRY_COLOR
+    elif iso_a3 in enemies_iso_list:
+        return ENEMY_COUNTRY_COLOR
+    return DEFAULT_COUNTRY_COLOR
+
+MAP_FIGSIZE = (10, 7) # Inches; rendered at MAP_DPI before cropping to the tight bounding box
+MAP_DPI = 100
+
+def create_map_axes(extent=DEFAULT_EXTENT):
+    """Creates the figure and PlateCarree axes every map render (and transform measurement) is laid out on."""
+    fig = plt.Figure(figsize=MAP_FIGSIZE, dpi=MAP_DPI) # Keep original figure size and DPI
+    ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    return fig, ax
+
+def build_map_figure(extent=DEFAULT_EXTENT, selected_iso=None, allies_iso_list=None, enemies_iso_list=None):
+    """
+    Builds the matplotlib figure for a world map with optional coloring and the specified extent.
+    The caller is responsible for saving and closing the figure. fig.country_layer holds the
+    drawn ISO codes and their collection (or None), so callers can recolor without rebuilding.
+    """
+    # Sets make the per-country membership tests below constant time
+    allies_iso_list = frozenset(allies_iso_list or ())
+    enemies_iso_list = frozenset(enemies_iso_list or ())
+
+    # Figure and axes for the current view
+    fig, ax = create_map_axes(extent)
+
+    ax.add_feature(cfeature.OCEAN, facecolor='#e0f2fe')
+    ax.add_feature(cfeature.LAND, facecolor='#f8f8f8', edgecolor='white')
+
+    # Only countries intersecting the view are drawn, at the level of detail for its width,
+    # as a single collection with one facecolor per country rather than one artist each
+    with timed_stage('geometry_lookup'):
+        countries = visible_countries(extent)
+    country_artist = None
+    if countries:
+        facecolors = [country_facecolor(iso_a3, selected_iso, allies_iso_list, enemies_iso_list)
+                      for iso_a3, _ in countries]
+        country_artist = ax.add_geometries([geom for _, geom in countries], ccrs.PlateCarree(),
+                                           facecolor=facecolors, edgecolor='white', linewidth=0.5, zorder=1)
+    fig.country_layer = ([iso_a3 for iso_a3, _ in countries], country_artist)
+
+    ax.add_feature(cfeature.BORDERS, linestyle=':', edgecolor='gray', zorder=2)
+    ax.add_feature(cfeature.COASTLINE, linewidth=0.5, edgecolor='gray', zorder=2)
+
+    fig.set_facecolor('#f3f4f6')
+    ax.set_facecolor('white')
+    return fig
+
+# Pixel <-> geographic transforms. A rendered map is cropped to its tight bounding box and the
+# GeoAxes keeps its aspect ratio, so the map area is a box inside the image rather than the
+# whole image. Each render records where its axes ended up and in which projection, and all
+# pixel conversions (clicks, zooms, bulk lookups, previews) go through that record.
+MAP_PROJECTIONS = { # Projection class name -> the CRS the app uses for it
+    "PlateCarree": ccrs.PlateCarree,
+    "Mercator": lambda: ccrs.Mercator.GOOGLE,
+    "Robinson": ccrs.Robinson,
+}
+_projections = {}
+
+def get_projection(name):
+    """Returns the (shared) cartopy CRS registered under name in MAP_PROJECTIONS."""
+    if name not in _projections:
+        if name not in MAP_PROJECTIONS:
+            raise ValueError(f"Unsupported map projection {name}")
+        _projections[name] = MAP_PROJECTIONS[name]()
+    return _projections[name]
+
+class MapTransform:
+    """
+    Maps pixel coordinates of a rendered map image to (lon, lat) and back. Holds the image size,
+    the axes box within the image as (left, top, right, bottom) pixels, and the axes extent in
+    projection coordinates as (x_min, x_max, y_min, y_max). Conversions take scalars or NumPy
+    arrays; display_size scales pixels of an image shown at another size. Pixels that fall
+    outside the projection's domain convert to NaN.
+    """
+
+    def __init__(self, image_size, axes_box, projected_extent, projection="PlateCarree"):
+        self.image_size = tuple(float(value) for value in image_size)
+        self.axes_box = tuple(float(value) for value in axes_box)
+        self.projected_extent = tuple(float(value) for value in projected_extent)
+        self.projection = projection
+
+    @classmethod
+    def from_axes(cls, ax, renderer, image_size, crop_origin):
+        """Records the transform of axes drawn by renderer into an image cropped at crop_origin (x, y)."""
+        box = ax.get_window_extent(renderer) # Display pixels, origin at the bottom left
+        canvas_height = ax.figure.bbox.height
+        crop_x, crop_y = crop_origin
+        axes_box = (box.x0 - crop_x, canvas_height - box.y1 - crop_y, box.x1 - crop_x, canvas_height - box.y0 - crop_y)
+        return cls(image_size, axes_box, ax.get_extent(), type(ax.projection).__name__)
+
+    def to_dict(self):
+        return {"image_size": list(self.image_size), "axes_box": list(self.axes_box),
+                "projected_extent": list(self.projected_extent), "projection": self.projection}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["image_size"], data["axes_box"], data["projected_extent"], data["projection"])
+
+    def _scale(self, display_size):
+        if display_size is None:
+            return 1.0, 1.0
+        return self.image_size[0] / display_size[0], self.image_size[1] / display_size[1]
+
+    def pixels_to_lonlat(self, x, y, display_size=None):
+        """Converts pixel coordinates (x right, y down) to (lon, lat)."""
+        scale_x, scale_y = self._scale(display_size)
+        x = np.asarray(x, dtype=float) * scale_x
+        y = np.asarray(y, dtype=float) * scale_y
+        left, top, right, bottom = self.axes_box
+        x_min, x_max, y_min, y_max = self.projected_extent
+        projected_x = x_min + (x - left) / (right - left) * (x_max - x_min)
+        projected_y = y_max - (y - top) / (bottom - top) * (y_max - y_min) # Pixel rows grow downwards
+        if self.projection == "PlateCarree":
+            return projected_x, projected_y
+        lonlat = get_projection("PlateCarree").transform_points(
+            get_projection(self.projection), np.atleast_1d(projected_x), np.atleast_1d(projected_y))
+        lonlat[~np.isfinite(lonlat)] = np.nan
+        return lonlat[..., 0].reshape(projected_x.shape), lonlat[..., 1].reshape(projected_y.shape)
+
+    def lonlat_to_pixels(self, lon, lat, display_size=None):
+        """Converts (lon, lat) to pixel coordinates (x right, y down) on the image."""
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        if self.projection == "PlateCarree":
+            projected_x, projected_y = lon, lat
+        else:
+            projected = get_projection(self.projection).transform_points(
+                get_projection("PlateCarree"), np.atleast_1d(lon), np.atleast_1d(lat))
+            projected[~np.isfinite(projected)] = np.nan
+            projected_x, projected_y = projected[..., 0].reshape(lon.shape), projected[..., 1].reshape(lat.shape)
+        left, top, right, bottom = self.axes_box
+        x_min, x_max, y_min, y_max = self.projected_extent
+        x = left + (projected_x - x_min) / (x_max - x_min) * (right - left)
+        y = top + (y_max - projected_y) / (y_max - y_min) * (bottom - top)
+        scale_x, scale_y = self._scale(display_size)
+        return x / scale_x, y / scale_y
+
+MAP_PAD_INCHES = 0.1 # Padding kept around the tight bounding box of a rendered map
+
+def rasterize_figure(fig, pad_inches=MAP_PAD_INCHES, ax=None):
+    """
+    Draws a figure with the Agg renderer and returns it as a uint8 RGBA array cropped to its
+    padded tight bounding box, like fig.savefig(..., bbox_inches='tight') (to within a pixel).
+    If ax is given, returns (image, MapTransform of ax within the cropped image) instead.
+    """
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    renderer = canvas.get_renderer()
+    bbox = fig.get_tightbbox(renderer).padded(pad_inches) # In inches
+    image = np.asarray(canvas.buffer_rgba())
+    height, width = image.shape[:2]
+    x0 = max(int(round(bbox.x0 * fig.dpi)), 0)
+    x1 = min(int(round(bbox.x1 * fig.dpi)), width)
+    y0 = max(int(round(height - bbox.y1 * fig.dpi)), 0) # Image rows start at the top
+    y1 = min(int(round(height - bbox.y0 * fig.dpi)), height)
+    cropped = image[y0:y1, x0:x1].copy()
+    if ax is None:
+        return cropped
+    return cropped, MapTransform.from_axes(ax, renderer, (x1 - x0, y1 - y0), (x0, y0))
+
+def compute_map_transform(extent):
+    """
+    Returns the MapTransform of maps rendered at extent without drawing anything, so request
+    threads never run matplotlib. It reproduces the layout of create_map_axes + rasterize_figure:
+    the default subplot box, shrunk to the extent's aspect ratio (PlateCarree keeps degrees equal)
+    and centered, then the tight crop padded by MAP_PAD_INCHES.
+    """
+    lon_min, lon_max, lat_min, lat_max = (float(value) for value in extent)
+    fig_width, fig_height = MAP_FIGSIZE[0] * MAP_DPI, MAP_FIGSIZE[1] * MAP_DPI
+    params = plt.rcParams
+    left = params['figure.subplot.left'] * fig_width
+    bottom = params['figure.subplot.bottom'] * fig_height
+    width = (params['figure.subplot.right'] - params['figure.subplot.left']) * fig_width
+    height = (params['figure.subplot.top'] - params['figure.subplot.bottom']) * fig_height
+
+    # Equal aspect shrinks the axes box along one side and centers it (display pixels, origin at the bottom left)
+    aspect = (lat_max - lat_min) / (lon_max - lon_min)
+    if height / width > aspect:
+        box_width, box_height = width, width * aspect
+    else:
+        box_width, box_height = height / aspect, height
+    x0 = left + (width - box_width) / 2
+    y0 = bottom + (height - box_height) / 2
+    x1, y1 = x0 + box_width, y0 + box_height
+
+    # Crop to the padded box exactly like rasterize_figure (image rows start at the top)
+    pad = MAP_PAD_INCHES * MAP_DPI
+    crop_x0 = max(int(round(x0 - pad)), 0)
+    crop_x1 = min(int(round(x1 + pad)), int(fig_width))
+    crop_y0 = max(int(round(fig_height - (y1 + pad))), 0)
+    crop_y1 = min(int(round(fig_height - (y0 - pad))), int(fig_height))
+    axes_box = (x0 - crop_x0, fig_height - y1 - crop_y0, x1 - crop_x0, fig_height - y0 - crop_y0)
+    return MapTransform((crop_x1 - crop_x0, crop_y1 - crop_y0), axes_box, (lon_min, lon_max, lat_min, lat_max))
+
+# Output encoding. PNG_COMPRESS_LEVEL trades encode time for size (zlib level 0-9);
+# MAP_IMAGE_FORMAT=webp produces smaller images for browsers that support WebP.
+MAP_IMAGE_FORMAT = os.environ.get('MAP_IMAGE_FORMAT', 'png').lower()
+PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', 6))
+WEBP_QUALITY = int(os.environ.get('WEBP_QUALITY', 80))
+WEBP_LOSSLESS = os.environ.get('WEBP_LOSSLESS', '1') == '1' # Flat map colors compress well losslessly
+IMAGE_MIMETYPES = {'png': 'image/png', 'webp': 'image/webp'}
+
+def encode_image(image, image_format=MAP_IMAGE_FORMAT):
+    """Encodes a uint8 RGBA array as PNG or WebP bytes."""
+    buffer = io.BytesIO()
+    pil_image = Image.fromarray(image, 'RGBA')
+    if image_format == 'webp':
+        pil_image.save(buffer, format='WEBP', quality=WEBP_QUALITY, lossless=WEBP_LOSSLESS)
+    else:
+        pil_image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+def render_full_map(extent=DEFAULT_EXTENT, selected_iso=None, allies_iso_list=None, enemies_iso_list=None):
+    """Renders a map with cartopy and returns (uint8 RGBA array, MapTransform)."""
+    with timed_stage('figure_build'):
+        fig = build_map_figure(extent, selected_iso, allies_iso_list, enemies_iso_list)
+    with timed_stage('rasterize'):
+        image, transform = rasterize_figure(fig, ax=fig.axes[0])
+    plt.close(fig)
+    return image, transform
+
+def write_image_file(image_path, data):
+    """Writes encoded image bytes to image_path atomically, so readers never see a partial file."""
+    os.makedirs(os.path.dirname(image_path) or '.', exist_ok=True)
+    tmp_path = f"{image_path}.{os.urandom(4).hex()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, image_path)
+
 def generate_world_map_image(image_path="static/world_map.png", extent=DEFAULT_EXTENT, selected_iso=None, allies_iso_list=None, enemies_iso_list=None):
     """
     Generates a static world map image with optional coloring and specified extent,
     and saves it to the specified path.
     """
-    if allies_iso_list is None:
-        allies_iso_list = []
-    if enemies_iso_list is None:
-        enemies_iso_list = []
-
     try:
-        fig = plt.Figure(figsize=(10, 7), dpi=100) # Keep original figure size and DPI
-        ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+        image, _ = render_full_map(extent, selected_iso, allies_iso_list, enemies_iso_list)
+        with timed_stage('image_encode'):
+            data = encode_image(image, 'png')
+        with timed_stage('file_write'):
+            write_image_file(image_path, data)
+        logger.info("Generated map image at %s", image_path, extra={"extent": extent})
+        return True
+    except Exception as e:
+        logger.exception("Error generating map image: %s", e)
+        return False
 
-        # Set the extent for the current view
-        ax.set_extent(extent, crs=ccrs.PlateCarree())
+# Layered rendering. Instead of redrawing every feature per request, the uncolored base map
+# and a label raster (the index of the country covering each pixel) are rendered once per
+# extent; colored maps are then produced by recoloring country pixels through a lookup table.
+# Building layers costs two cartopy draws, so an extent's first map is rendered in full and its
+# layers are only built when it is rendered again. Set MAP_RENDER_MODE=full to always use the
+# full cartopy render.
+RENDER_MODE = os.environ.get('MAP_RENDER_MODE', 'layered')
+LAYER_CACHE_MAX_EXTENTS = int(os.environ.get('LAYER_CACHE_MAX_EXTENTS', 8))
+_map_layers = OrderedDict() # tuple(extent) -> layers dict, least recently used first
+_layer_candidates = OrderedDict() # tuple(extent) -> None for extents rendered once in full, oldest first
+_map_layers_lock = threading.Lock()
 
-        ax.add_feature(cfeature.OCEAN, facecolor='#e0f2fe')
-        ax.add_feature(cfeature.LAND, facecolor='#f8f8f8', edgecolor='white')
+def build_label_figure(extent, countries):
+    """
+    Builds a figure with the same layout as build_map_figure where each (iso_a3, geometry) in
+    `countries` is filled, without antialiasing, with a color encoding its 1-based index.
+    Pixels outside every country decode to 0.
+    """
+    fig, ax = create_map_axes(extent)
 
-        for iso_a3, data in _country_geometries.items():
-            geom = data['geometry']
-            facecolor = '#cbd5e0' # Default grey
+    if countries:
+        indices = np.arange(1, len(countries) + 1)
+        label_colors = np.column_stack([(indices >> 16) & 0xFF, (indices >> 8) & 0xFF, indices & 0xFF]) / 255
+        ax.add_geometries([geom for _, geom in countries], ccrs.PlateCarree(),
+                          facecolor=label_colors, edgecolor='none', linewidth=0, antialiased=False, zorder=1)
 
-            if selected_iso and iso_a3 == selected_iso:
-                facecolor = 'orange'
-            elif iso_a3 in allies_iso_list:
-                facecolor = 'green'
-            elif iso_a3 in enemies_iso_list:
-                facecolor = 'red'
+    # Keep the frame so the tight bounding box matches the full render, but make it decode as 0
+    ax.spines['geo'].set_edgecolor('black')
+    fig.set_facecolor('black')
+    ax.set_facecolor('black')
+    return fig
 
-            ax.add_geometries([geom], ccrs.PlateCarree(),
-                                 facecolor=facecolor, edgecolor='white', linewidth=0.5, zorder=1)
+def get_map_layers(extent):
+    """
+    Returns the cached layers for an extent, rendering the base map and label raster on first use.
+    The layers dict holds the base RGBA image, the ISO codes by label index, and a label raster
+    restricted to pixels that still show the plain country fill (so borders, coastlines and
+    antialiased edges drawn on top are preserved when recoloring), plus the base's MapTransform.
+    """
+    key = tuple(extent)
+    with _map_layers_lock:
+        if key in _map_layers:
+            _map_layers.move_to_end(key)
+            return _map_layers[key]
 
-        ax.add_feature(cfeature.BORDERS, linestyle=':', edgecolor='gray', zorder=2)
-        ax.add_feature(cfeature.COASTLINE, linewidth=0.5, edgecolor='gray', zorder=2)
+    countries = visible_countries(extent)
+    isos = [iso_a3 for iso_a3, _ in countries]
+    with timed_stage('layer_build'):
+        with timed_stage('figure_build'):
+            base_fig = build_map_figure(extent)
+            label_fig = build_label_figure(extent, countries)
+        with timed_stage('rasterize'):
+            base, transform = rasterize_figure(base_fig, ax=base_fig.axes[0])
+            label_rgba = rasterize_figure(label_fig)
+        plt.close(base_fig)
+        plt.close(label_fig)
+    if base.shape != label_rgba.shape:
+        raise ValueError(f"Label raster {label_rgba.shape} does not match base layer {base.shape}")
 
-        fig.set_facecolor('#f3f4f6')
-        ax.set_facecolor('white')
+    labels = (label_rgba[..., 0].astype(np.int32) << 16) | (label_rgba[..., 1].astype(np.int32) << 8) | label_rgba[..., 2]
+    labels[labels > len(isos)] = 0 # Anything that is not an exact label color is background
+    default_rgba = np.round(np.array(mcolors.to_rgba(DEFAULT_COUNTRY_COLOR)) * 255).astype(np.int16)
+    plain_fill = np.all(np.abs(base.astype(np.int16) - default_rgba) <= 2, axis=-1)
 
-        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        fig.savefig(image_path, bbox_inches='tight', pad_inches=0.1)
-        plt.close(fig)
-        print(f"Generated map image at {image_path} with extent: {extent}")
+    layers = {
+        "base": base,
+        "isos": isos,
+        "iso_index": {iso: index for index, iso in enumerate(isos, start=1)},
+        "paint_labels": np.where(plain_fill, labels, 0),
+        "transform": transform,
+    }
+    with _map_layers_lock:
+        _map_layers[key] = layers
+        while len(_map_layers) > LAYER_CACHE_MAX_EXTENTS:
+            _map_layers.popitem(last=False)
+    return layers
+
+def composite_map_image(layers, selected_iso=None, allies_iso_list=None, enemies_iso_list=None):
+    """Recolors the base layer through a per-country color lookup table and returns an RGBA array."""
+    iso_index = layers["iso_index"]
+    lut = np.zeros((len(layers["isos"]) + 1, 4), dtype=np.uint8)
+    active = np.zeros(len(layers["isos"]) + 1, dtype=bool)
+
+    # Assign in reverse precedence so the selected country wins over allies, and allies over enemies
+    for iso_list, color in ((enemies_iso_list or [], ENEMY_COUNTRY_COLOR),
+                            (allies_iso_list or [], ALLY_COUNTRY_COLOR),
+                            ([selected_iso] if selected_iso else [], SELECTED_COUNTRY_COLOR)):
+        rgba = np.round(np.array(mcolors.to_rgba(color)) * 255).astype(np.uint8)
+        for iso_a3 in iso_list:
+            index = iso_index.get(iso_a3)
+            if index is not None:
+                lut[index] = rgba
+                active[index] = True
+
+    image = layers["base"].copy()
+    if active.any():
+        paint_labels = layers["paint_labels"]
+        mask = active[paint_labels]
+        image[mask] = lut[paint_labels[mask]]
+    return image
+
+def render_composited_map(extent=DEFAULT_EXTENT, selected_iso=None, allies_iso_list=None, enemies_iso_list=None):
+    """
+    Layered equivalent of render_full_map: recolors the cached base layer for the extent
+    (rendering it first if the extent is new) and returns (uint8 RGBA array, MapTransform).
+    """
+    layers = get_map_layers(extent)
+    with timed_stage('composite'):
+        return composite_map_image(layers, selected_iso, allies_iso_list, enemies_iso_list), layers["transform"]
+
+def should_layer_extent(extent):
+    """
+    Whether a render of extent should go through its layers: true once the layers exist or the
+    extent has been rendered before. A first-seen extent is only remembered, since most zoom
+    extents are never requested twice and a full render is cheaper than building layers.
+    """
+    key = tuple(extent)
+    with _map_layers_lock:
+        if key in _map_layers:
+            return True
+        if key in _layer_candidates:
+            del _layer_candidates[key]
+            return True
+        _layer_candidates[key] = None
+        while len(_layer_candidates) > 16 * LAYER_CACHE_MAX_EXTENTS:
+            _layer_candidates.popitem(last=False)
+        return False
+
+def render_map_array(extent=DEFAULT_EXTENT, selected_iso=None, allies_iso_list=None, enemies_iso_list=None):
+    """
+    Renders a map using the configured RENDER_MODE, falling back to a full render if layering
+    fails. Returns (uint8 RGBA array, MapTransform).
+    """
+    if RENDER_MODE == 'layered' and should_layer_extent(extent):
+        try:
+            return render_composited_map(extent, selected_iso, allies_iso_list, enemies_iso_list)
+        except Exception as e:
+            logger.exception("Error compositing map image, falling back to a full render: %s", e)
+    return render_full_map(extent, selected_iso, allies_iso_list, enemies_iso_list)
+
+# Render service configuration. Renders run in a pool of worker processes (matplotlib is not
+# thread-safe) so web workers are never blocked on CPU for longer than they wait on a result.
+# RENDER_WORKERS=0 renders inline in the calling thread instead. Each web worker process owns
+# its own pool, so the total is web workers x RENDER_WORKERS; set RENDER_SERVICE_ADDRESS to
+# send every web worker's renders to one shared `flask render-server` process instead.
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 2))
+RENDER_SERVICE_ADDRESS = os.environ.get('RENDER_SERVICE_ADDRESS') # host:port or Unix socket path
+RENDER_SERVICE_AUTHKEY = os.environ.get('RENDER_SERVICE_AUTHKEY')
+RENDER_QUEUE_LIMIT = int(os.environ.get('RENDER_QUEUE_LIMIT', 32)) # Max distinct renders in flight
+RENDER_TIMEOUT = float(os.environ.get('RENDER_TIMEOUT', 60)) # Seconds a caller waits for a render
+RENDER_START_METHOD = os.environ.get('RENDER_START_METHOD', 'fork' if os.name == 'posix' else 'spawn')
+
+class RenderQueueFull(Exception):
+    """Raised when the render service already has RENDER_QUEUE_LIMIT renders in flight."""
+
+class RenderService:
+    """
+    Runs render jobs in a bounded process pool. Concurrent requests for the same job key
+    share a single in-flight render, and new jobs are rejected once the queue limit is reached.
+    """
+
+    def __init__(self, max_workers=RENDER_WORKERS, queue_limit=RENDER_QUEUE_LIMIT):
+        self.max_workers = max_workers
+        self.queue_limit = queue_limit
+        self._executor = None # Created on first use so importing the app never forks
+        self._in_flight = {} # job key -> Future
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1024) # Recent render latencies in seconds
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _get_executor(self):
+        """Returns the process pool, creating it if needed. Caller holds the lock."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context(RENDER_START_METHOD)
+            )
+        return self._executor
+
+    def _on_done(self, key, started, future):
+        succeeded = not future.cancelled() and future.exception() is None
+        with self._lock:
+            self._in_flight.pop(key, None)
+            self._latencies.append(time.perf_counter() - started)
+            if succeeded and future.result()[0]:
+                self.completed += 1
+            else:
+                self.failed += 1
+        # Record the stages timed in the worker once per job, however many callers share it
+        if succeeded:
+            for stage, seconds in future.result()[1]:
+                record_stage(stage, seconds)
+
+    def submit(self, key, fn, *args):
+        """
+        Submits fn(*args) to the pool unless a job with the same key is already running,
+        in which case the running job's future is returned. Raises RenderQueueFull when saturated.
+        The future resolves to (result, stage timings); see run_with_stage_timings.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if len(self._in_flight) >= self.queue_limit:
+                self.rejected += 1
+                raise RenderQueueFull(f"{len(self._in_flight)} renders already in flight")
+            started = time.perf_counter()
+            future = self._get_executor().submit(run_with_stage_timings, fn, *args)
+            self._in_flight[key] = future
+            self.submitted += 1
+        future.add_done_callback(lambda done: self._on_done(key, started, done))
+        return future
+
+    def run(self, key, fn, *args, timeout=RENDER_TIMEOUT):
+        """Runs fn(*args) through the pool (or inline if there are no workers) and returns its result."""
+        if self.max_workers <= 0:
+            started = time.perf_counter()
+            result = fn(*args)
+            with self._lock:
+                self._latencies.append(time.perf_counter() - started)
+                self.submitted += 1
+                if result:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            return result
+
+        future = self.submit(key, fn, *args)
+        try:
+            return future.result(timeout=timeout)[0]
+        except FutureTimeoutError:
+            logger.warning("Render %s did not finish within %ss", key, timeout)
+            return None
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed for memory); start a fresh pool for the next job
+            logger.error("Render pool broken while rendering %s: %s", key, e)
+            with self._lock:
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = None
+            return None
+
+    def stats(self):
+        """Returns queue depth, counters and render latency percentiles as a JSON-serializable dict."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            in_flight = len(self._in_flight)
+            stats = {
+                "workers": self.max_workers,
+                "queue_limit": self.queue_limit,
+                "in_flight": in_flight,
+                "queued": max(0, in_flight - self.max_workers),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+        if latencies:
+            stats["latency_seconds"] = {
+                "mean": sum(latencies) / len(latencies),
+                "p50": latencies[int(0.50 * (len(latencies) - 1))],
+                "p95": latencies[int(0.95 * (len(latencies) - 1))],
+                "max": latencies[-1],
+            }
+        return stats
+
+class RenderServerManager(BaseManager):
+    """Serves (or connects to) the render service of a `flask render-server` process."""
+
+RenderServerManager.register('render_service') # The server registers its own service instead
+
+def parse_render_service_address(address):
+    """Parses host:port into a TCP address tuple; anything else is a Unix socket path."""
+    host, _, port = address.rpartition(':')
+    return (host, int(port)) if host and port.isdigit() else address
+
+class RemoteRenderService:
+    """
+    Client for a render service shared by all web workers (see `flask render-server`). Jobs with
+    the same key are coalesced across web workers, and the render pool is sized independently of
+    them. RenderQueueFull raised by the server propagates to the caller.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = parse_render_service_address(address)
+        self.authkey = authkey.encode('utf-8')
+        self._proxy = None # Connected on first use, after the web worker has forked
+        self._max_workers = None
+        self._lock = threading.Lock()
+
+    def _service(self):
+        with self._lock:
+            if self._proxy is None:
+                manager = RenderServerManager(address=self.address, authkey=self.authkey)
+                manager.connect()
+                self._proxy = manager.render_service()
+            return self._proxy
+
+    def _reset(self, error):
+        logger.error("Lost connection to the render server at %s: %s", self.address, error)
+        with self._lock:
+            self._proxy = None
+
+    @property
+    def max_workers(self):
+        """Size of the server's render pool (1 while the server is unreachable)."""
+        if self._max_workers is None:
+            try:
+                self._max_workers = self._service().stats()["workers"]
+            except (OSError, EOFError) as e:
+                self._reset(e)
+                return 1
+        return self._max_workers
+
+    def run(self, key, fn, *args, timeout=RENDER_TIMEOUT):
+        """Runs fn(*args) in the render server and returns its result, or None if it is unreachable."""
+        try:
+            return self._service().run(key, fn, *args, timeout=timeout)
+        except (OSError, EOFError) as e:
+            self._reset(e)
+            return None
+
+    def stats(self):
+        try:
+            stats = self._service().stats()
+        except (OSError, EOFError) as e:
+            self._reset(e)
+            counters = ('in_flight', 'queued', 'submitted', 'coalesced', 'rejected', 'completed', 'failed')
+            return {"server": str(self.address), "reachable": False, **dict.fromkeys(counters, 0)}
+        return {**stats, "server": str(self.address)}
+
+if RENDER_SERVICE_ADDRESS:
+    if not RENDER_SERVICE_AUTHKEY:
+        raise RuntimeError("RENDER_SERVICE_ADDRESS is set but RENDER_SERVICE_AUTHKEY is not")
+    render_service = RemoteRenderService(RENDER_SERVICE_ADDRESS, RENDER_SERVICE_AUTHKEY)
+else:
+    render_service = RenderService()
+
+def render_map_bytes(extent, selected_iso=None, allies_iso_list=None, enemies_iso_list=None, image_format=MAP_IMAGE_FORMAT):
+    """
+    Render job executed in a worker process: returns (encoded map image, MapTransform as a dict),
+    or None on failure. Images are handed back to the web process in memory, never written to disk.
+    """
+    try:
+        image, transform = render_map_array(extent, selected_iso, allies_iso_list, enemies_iso_list)
+        with timed_stage('image_encode'):
+            data = encode_image(image, image_format)
+        logger.debug("Rendered %s map", image_format, extra={"bytes": len(data), "extent": extent})
+        return data, transform.to_dict()
     except Exception as e:
-        print(f"Error generating map image: {e}")
+        logger.exception("Error generating map image: %s", e)
+        return None
+
+@app.errorhandler(RenderQueueFull)
+def render_queue_full(error):
+    """Sheds load with a 503 when the render service is saturated."""
+    logger.warning("Rejecting request, render queue full: %s", error)
+    response = jsonify({"error": "Map renderer is busy, please retry shortly"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+# Render cache configuration. Rendered maps are kept in memory and served from /map/<digest>,
+# named after a hash of their render inputs so identical views requested by different users
+# share one entry. Set RENDER_CACHE_SHARED_FOLDER to also share images between worker processes.
+RENDER_CACHE_MAX_ENTRIES = int(os.environ.get('RENDER_CACHE_MAX_ENTRIES', 512))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+RENDER_CACHE_TTL = float(os.environ.get('RENDER_CACHE_TTL', 60 * 60)) # Seconds an image is kept after rendering
+RENDER_CACHE_SHARED_FOLDER = os.environ.get('RENDER_CACHE_SHARED_FOLDER')
+RENDER_CACHE_SHARED_MAX_FILES = int(os.environ.get('RENDER_CACHE_SHARED_MAX_FILES', 4096))
+EXTENT_QUANTUM = 0.01 # Extents are snapped to this grid (degrees) before hashing
+
+def quantize_extent(extent):
+    """Snaps an extent to the EXTENT_QUANTUM grid so near-identical views share a cache entry."""
+    return [round(round(value / EXTENT_QUANTUM) * EXTENT_QUANTUM, 6) for value in extent]
+
+def render_cache_key(extent, selected_iso=None, allies_iso_list=None, enemies_iso_list=None, image_format=MAP_IMAGE_FORMAT,
+                     data_version=None):
+    """
+    Returns a stable hex digest identifying a map render.
+    Ally/enemy lists are de-duplicated and sorted since their order does not affect the image.
+    data_version is the selected country's relations version (see RelationGraph.country_version).
+    """
+    normalized = {
+        "extent": quantize_extent(extent),
+        "selected": selected_iso,
+        "allies": sorted(set(allies_iso_list or [])),
+        "enemies": sorted(set(enemies_iso_list or [])),
+        "format": image_format,
+    }
+    if data_version is not None:
+        normalized["version"] = data_version
+    payload = json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+class RenderCache:
+    """
+    Content-addressed store of encoded map images held in memory, bounded by entry count and
+    bytes with LRU eviction, and expiring entries RENDER_CACHE_TTL seconds after rendering.
+    The render inputs of each digest are remembered for longer than the image itself, so a
+    URL whose image was evicted is re-rendered on request rather than broken. Pinned entries
+    (the warmed hot views) are kept outside the LRU and never expire or get evicted.
+    """
+
+    def __init__(self, max_entries=RENDER_CACHE_MAX_ENTRIES, max_bytes=RENDER_CACHE_MAX_BYTES,
+                 ttl=RENDER_CACHE_TTL, shared_folder=RENDER_CACHE_SHARED_FOLDER,
+                 shared_max_files=RENDER_CACHE_SHARED_MAX_FILES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared_folder = shared_folder
+        self.shared_max_files = shared_max_files
+        self._entries = OrderedDict() # digest -> (data, image_format, created), oldest first
+        self._params = OrderedDict() # digest -> render arguments, oldest first
+        self._pinned = {} # digest -> (data, image_format, selected_iso), exempt from eviction and expiry
+        self._pinned_bytes = 0
+        self._pending = set() # digests being rendered in the background by render_async
+        self._transforms = OrderedDict() # digest -> MapTransform recorded when the image was rendered
+        self._total_bytes = 0
+        self._shared_writes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _shared_path(self, digest, image_format):
+        return os.path.join(self.shared_folder, f"{digest}.{image_format}")
+
+    def _drop(self, digest):
+        """Removes an entry from memory. Caller holds the lock."""
+        data, _, _ = self._entries.pop(digest)
+        self._total_bytes -= len(data)
+
+    def _store(self, digest, data, image_format, created=None, pin=False, selected_iso=None):
+        """
+        Records an entry as most recently used and evicts old entries. Caller holds the lock.
+        Pinned entries keep their selected country, since their render inputs may be evicted
+        from _params long before the image, and invalidate() still has to find them.
+        """
+        if digest in self._entries:
+            self._drop(digest)
+        if pin or digest in self._pinned:
+            old = self._pinned.get(digest)
+            self._pinned_bytes += len(data) - (len(old[0]) if old else 0)
+            self._pinned[digest] = (data, image_format, old[2] if old else selected_iso)
+            return
+        self._entries[digest] = (data, image_format, created or time.time())
+        self._total_bytes += len(data)
+        while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _lookup(self, digest, image_format):
+        """Returns cached image bytes from memory or the shared folder, or None. Counts hits."""
+        now = time.time()
+        with self._lock:
+            pinned = self._pinned.get(digest)
+            if pinned is not None and pinned[1] == image_format:
+                self.hits += 1
+                return pinned[0]
+            entry = self._entries.get(digest)
+            if entry is not None:
+                data, entry_format, created = entry
+                if now - created > self.ttl:
+                    self._drop(digest)
+                    self.expirations += 1
+                elif entry_format == image_format:
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return data
+
+        # Another worker process may already have rendered this view into the shared folder
+        if self.shared_folder:
+            path = self._shared_path(digest, image_format)
+            try:
+                if now - os.path.getmtime(path) <= self.ttl:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    with self._lock:
+                        self.hits += 1
+                        self._store(digest, data, image_format, os.path.getmtime(path))
+                    return data
+            except OSError:
+                pass # Not rendered by anyone yet (or pruned meanwhile)
+        return None
+
+    def _write_shared(self, digest, data, image_format):
+        """Writes an image into the shared folder atomically, pruning the oldest files now and then."""
+        os.makedirs(self.shared_folder, exist_ok=True)
+        path = self._shared_path(digest, image_format)
+        tmp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self._shared_writes += 1
+        if self._shared_writes % 64 == 0:
+            files = [os.path.join(self.shared_folder, name) for name in os.listdir(self.shared_folder)
+                     if not name.endswith('.tmp')]
+            if len(files) > self.shared_max_files:
+                files.sort(key=lambda file_path: os.path.getmtime(file_path))
+                for file_path in files[:len(files) - self.shared_max_files]:
+                    try:
+                        os.unlink(file_path)
+                    except OSError:
+                        pass
+
+    def _render(self, digest, params, pin=False):
+        """Renders through the render service and stores the result. Returns the bytes or None."""
+        result = render_service.run(digest, render_map_bytes, *params)
+        if not result:
+            return None
+        data, transform = result
+        image_format = params[-1]
+        if METRICS_ENABLED:
+            MAP_IMAGE_BYTES.observe(len(data), format=image_format)
+        with self._lock:
+            self._store(digest, data, image_format, pin=pin, selected_iso=params[1])
+            self._transforms[digest] = MapTransform.from_dict(transform)
+            self._transforms.move_to_end(digest)
+            while len(self._transforms) > 4 * self.max_entries:
+                self._transforms.popitem(last=False)
+        if self.shared_folder:
+            try:
+                self._write_shared(digest, data, image_format)
+            except OSError as e:
+                logger.warning("Could not write %s to the shared render folder: %s", digest, e)
+        return data
+
+    def _remember(self, extent, selected_iso, allies_iso_list, enemies_iso_list, image_format, data_version):
+        """Computes the digest of a render and records its inputs. Returns (digest, params)."""
+        digest = render_cache_key(extent, selected_iso, allies_iso_list, enemies_iso_list, image_format, data_version)
+        params = (quantize_extent(extent), selected_iso, sorted(set(allies_iso_list or [])),
+                  sorted(set(enemies_iso_list or [])), image_format)
+        with self._lock:
+            self._params[digest] = params
+            self._params.move_to_end(digest)
+            while len(self._params) > 4 * self.max_entries:
+                self._params.popitem(last=False)
+        return digest, params
+
+    def is_ready(self, digest, image_format=MAP_IMAGE_FORMAT):
+        """Whether an image is cached (in memory or the shared folder) without rendering or counting a lookup."""
+        with self._lock:
+            pinned = self._pinned.get(digest)
+            if pinned is not None and pinned[1] == image_format:
+                return True
+            entry = self._entries.get(digest)
+            if entry is not None and entry[1] == image_format and time.time() - entry[2] <= self.ttl:
+                return True
+        if self.shared_folder:
+            try:
+                return time.time() - os.path.getmtime(self._shared_path(digest, image_format)) <= self.ttl
+            except OSError:
+                return False
+        return False
+
+    def transform(self, digest):
+        """Returns the MapTransform recorded when digest was rendered in this process, or None."""
+        with self._lock:
+            return self._transforms.get(digest)
+
+    def is_pending(self, digest):
+        """Whether a background render started by render_async is still running for a digest."""
+        with self._lock:
+            return digest in self._pending
+
+    def _render_pending(self, digest, params):
+        try:
+            self._render(digest, params)
+        except RenderQueueFull as e:
+            logger.warning("Background render of %s rejected: %s", digest, e)
+        finally:
+            with self._lock:
+                self._pending.discard(digest)
+
+    def render_async(self, extent, selected_iso=None, allies_iso_list=None, enemies_iso_list=None, image_format=MAP_IMAGE_FORMAT,
+                     data_version=None):
+        """
+        Like get_or_render, but returns the digest right away and renders a missing image in a
+        background thread; poll is_ready/is_pending to find out when it is available.
+        Without render workers the image is rendered before returning, since matplotlib must
+        not run in several threads of one process.
+        """
+        digest, params = self._remember(extent, selected_iso, allies_iso_list, enemies_iso_list, image_format, data_version)
+        if self.is_ready(digest, image_format):
+            return digest
+        with self._lock:
+            if digest in self._pending:
+                return digest
+            self._pending.add(digest)
+            self.misses += 1
+        if render_service.max_workers <= 0:
+            self._render_pending(digest, params)
+        else:
+            threading.Thread(target=self._render_pending, args=(digest, params), daemon=True).start()
+        return digest
+
+    def peek(self, digest, image_format=MAP_IMAGE_FORMAT):
+        """Returns (image bytes, render params) for a cached image, or None. Never renders."""
+        data = self._lookup(digest, image_format)
+        if data is None:
+            return None
+        with self._lock:
+            params = self._params.get(digest)
+        return (data, params) if params is not None else None
+
+    def get_or_render(self, extent, selected_iso=None, allies_iso_list=None, enemies_iso_list=None, image_format=MAP_IMAGE_FORMAT,
+                      data_version=None, pin=False):
+        """
+        Returns the digest of the map for the given render inputs, rendering it only if
+        no cached image exists. Returns None if rendering fails. With pin=True the image
+        is kept until invalidated or cleared, regardless of TTL and size limits.
+        """
+        digest, params = self._remember(extent, selected_iso, allies_iso_list, enemies_iso_list, image_format, data_version)
+        data = self._lookup(digest, image_format)
+        if data is not None:
+            if pin:
+                with self._lock:
+                    self._store(digest, data, image_format, pin=True, selected_iso=selected_iso)
+            return digest
+        with self._lock:
+            self.misses += 1
+        # Concurrent misses for the same view share one render in the render service
+        return digest if self._render(digest, params, pin=pin) is not None else None
+
+    def get(self, digest, image_format=MAP_IMAGE_FORMAT):
+        """Returns the image bytes for a digest, re-rendering it if it was evicted. None if unknown."""
+        data = self._lookup(digest, image_format)
+        if data is not None:
+            return data
+        with self._lock:
+            params = self._params.get(digest)
+            if params is None or params[-1] != image_format:
+                return None
+            self.misses += 1
+        return self._render(digest, params)
+
+    def invalidate(self, selected_isos):
+        """
+        Drops the images (in memory and in the shared folder) and remembered render inputs of every
+        map whose selected country is in selected_isos. Returns the number of maps invalidated.
+        """
+        selected_isos = set(selected_isos)
+        with self._lock:
+            stale = {digest: params[-1] for digest, params in self._params.items() if params[1] in selected_isos}
+            stale.update((digest, pinned[1]) for digest, pinned in self._pinned.items() if pinned[2] in selected_isos)
+            stale = list(stale.items())
+            for digest, _ in stale:
+                self._params.pop(digest, None)
+                self._transforms.pop(digest, None)
+                if digest in self._entries:
+                    self._drop(digest)
+                if digest in self._pinned:
+                    self._pinned_bytes -= len(self._pinned.pop(digest)[0])
+            self.invalidations += len(stale)
+        if self.shared_folder:
+            for digest, image_format in stale:
+                try:
+                    os.unlink(self._shared_path(digest, image_format))
+                except OSError:
+                    pass
+        return len(stale)
+
+    def clear(self):
+        """Drops every image held in memory and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+            self._total_bytes = self._pinned_bytes = 0
+            self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def stats(self):
+        """Returns hit/miss counters and current usage as a JSON-serializable dict."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "pinned_entries": len(self._pinned),
+                "pinned_bytes": self._pinned_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "shared_folder": self.shared_folder,
+            }
+
+render_cache = RenderCache()
+
+def extent_to_bbox(extent):
+    """Formats a [lon_min, lon_max, lat_min, lat_max] extent as a W,S,E,N bbox query parameter."""
+    return ','.join(f"{value:g}" for value in (extent[0], extent[2], extent[1], extent[3]))
+
+def map_image_url(digest, extent, selected_iso=None, image_format=MAP_IMAGE_FORMAT):
+    """
+    Returns the /map URL of a digest. The URL also carries the view (bbox and selected country),
+    so a worker process that never rendered the digest can re-render it (see serve_map).
+    """
+    if selected_iso:
+        return url_for('serve_map', digest=digest, ext=image_format, bbox=extent_to_bbox(extent), sel=selected_iso)
+    return url_for('serve_map', digest=digest, ext=image_format, bbox=extent_to_bbox(extent))
+
+def fallback_map_url():
+    """URL of the bundled default image shown when a render fails."""
+    return url_for('static', filename='world_map_default.png')
+
+def cached_map_url(extent, selected_iso=None, allies_iso_list=None, enemies_iso_list=None, data_version=None):
+    """Returns the URL of the (possibly cached) map for the given render inputs."""
+    digest = render_cache.get_or_render(extent, selected_iso, allies_iso_list, enemies_iso_list,
+                                        data_version=data_version)
+    if digest is None:
+        # Rendering failed; fall back to the bundled default image rather than a broken link
+        return fallback_map_url()
+    return map_image_url(digest, extent, selected_iso)
+
+# Cache warming. The default map and the colored global view of every country with relations
+# data are the views nearly every visitor requests first, so they can be rendered ahead of
+# traffic (in parallel through the render service) and pinned in the render cache. Set
+# WARM_RENDER_CACHE=1 to warm each process in the background at boot, or run
+# `flask --app app warm-cache` (with RENDER_CACHE_SHARED_FOLDER set) to warm a shared folder.
+WARM_RENDER_CACHE = os.environ.get('WARM_RENDER_CACHE', '0') == '1'
+_warmed = False # Whether a full warm-up has completed in this process
+
+def warm_render_cache(countries=None, include_default=True, extent=DEFAULT_EXTENT):
+    """
+    Renders and pins the default map and the colored view of each country (all countries in
+    the relation graph if None) at the given extent. Returns (rendered, failed) counts.
+    """
+    global _warmed
+    started = time.perf_counter()
+    graph = relation_graph
+    jobs = [dict()] if include_default else []
+    for iso in sorted(graph.versions if countries is None else countries):
+        allies, enemies = graph.relations(iso)
+        jobs.append(dict(selected_iso=iso, allies_iso_list=allies, enemies_iso_list=enemies,
+                         data_version=graph.country_version(iso)))
+
+    # Build the base layers before the render pool forks, so every worker inherits them
+    if RENDER_MODE == 'layered':
+        get_map_layers(quantize_extent(extent))
+
+    def warm(job):
+        try:
+            return render_cache.get_or_render(extent, pin=True, **job) is not None
+        except RenderQueueFull:
+            return False # Live traffic saturated the queue; this view renders on first request instead
+
+    # One job per worker keeps the pool busy without crowding out the render queue
+    with ThreadPoolExecutor(max_workers=max(1, render_service.max_workers)) as threads:
+        results = list(threads.map(warm, jobs))
+    rendered, failed = results.count(True), results.count(False)
+    if countries is None and include_default:
+        _warmed = True
+    logger.info("Warmed render cache: %d views ready, %d failed in %.1fs.", rendered, failed, time.perf_counter() - started)
+    return rendered, failed
+
+@app.cli.command('warm-cache')
+@click.option('--no-default', is_flag=True, help='Skip the uncolored default map.')
+@click.argument('countries', nargs=-1)
+def warm_cache_command(no_default, countries):
+    """Renders the default map and each country's global view (or only the given ISO codes)."""
+    if not render_cache.shared_folder:
+        click.echo("RENDER_CACHE_SHARED_FOLDER is not set; the warmed images only live in this process.")
+    rendered, failed = warm_render_cache(countries or None, include_default=not no_default)
+    click.echo(f"{rendered} views ready, {failed} failed")
+
+# Progressive zooms. Instead of waiting for the zoomed map, a zoom answers right away with a
+# preview (the parent view's cached image, cropped to the new extent and upscaled) while the
+# full-quality map renders in the background; the page polls /map_status and swaps it in.
+PREVIEW_COMPRESS_LEVEL = 1 # Previews are short-lived, so favor encoding speed over size
+
+def progressive_map_urls(extent, parent_extent, parent_render_args=(None, None, None), data_version=None, parent_data_version=None):
+    """
+    Starts a background render of the default-colored map for extent and returns its URLs:
+    map_url (the final image), status_url (to poll) and preview_url (an approximation cropped
+    from the parent view's image, given by parent_extent and its (selected, allies, enemies)).
+    """
+    digest = render_cache.render_async(extent, data_version=data_version)
+    parent_digest = render_cache_key(parent_extent, *parent_render_args, MAP_IMAGE_FORMAT, parent_data_version)
+    return {
+        "map_url": map_image_url(digest, extent),
+        "status_url": url_for('map_status', digest=digest, ext=MAP_IMAGE_FORMAT),
+        "preview_url": url_for('map_preview', digest=parent_digest, ext=MAP_IMAGE_FORMAT, bbox=extent_to_bbox(extent)),
+    }
+
+@app.route('/map_preview/<digest>.<ext>')
+def map_preview(digest, ext):
+    """
+    Serves a preview of ?bbox=W,S,E,N cropped from the cached map `digest` and upscaled into the
+    new view's layout. Only already-cached maps are used (404 otherwise), so a preview never
+    triggers a render.
+    """
+    if ext not in IMAGE_MIMETYPES:
+        abort(404)
+    try:
+        target = bbox_to_extent(parse_floats(request.args.get('bbox', ''), 4, 'bbox'))
+    except ValueError:
+        abort(400)
+    cached = render_cache.peek(digest, ext)
+    if cached is None:
+        abort(404)
+    data, params = cached
+
+    with timed_stage('preview'):
+        parent = Image.open(io.BytesIO(data))
+        width, height = parent.size
+        # Locate the new extent's corners on the parent image through its recorded transform
+        xs, ys = view_transform(params[0], digest).lonlat_to_pixels([target[0], target[1]], [target[3], target[2]])
+        if not (np.isfinite(xs).all() and np.isfinite(ys).all()):
+            abort(404)
+        left, right = float(xs[0]), float(xs[1])
+        top, bottom = float(ys[0]), float(ys[1])
+        left, top = max(0, left), max(0, top)
+        right, bottom = min(width, right), min(height, bottom)
+        if right - left < 1 or bottom - top < 1:
+            abort(404) # The new extent lies outside the parent view
+        # Scale the crop into the map area of the new view's layout, so it lines up with the final image
+        target_transform = compute_map_transform(target)
+        target_width, target_height = (int(round(value)) for value in target_transform.image_size)
+        box_left, box_top, box_right, box_bottom = (int(round(value)) for value in target_transform.axes_box)
+        crop = parent.convert('RGBA').resize((box_right - box_left, box_bottom - box_top), Image.BILINEAR,
+                                             box=(left, top, right, bottom))
+        preview = Image.new('RGBA', (target_width, target_height), (255, 255, 255, 255))
+        preview.paste(crop, (box_left, box_top))
+        buffer = io.BytesIO()
+        if ext == 'webp':
+            preview.save(buffer, format='WEBP', quality=50)
+        else:
+            preview.save(buffer, format='PNG', compress_level=PREVIEW_COMPRESS_LEVEL)
+
+    response = Response(buffer.getvalue(), mimetype=IMAGE_MIMETYPES[ext])
+    response.set_etag(hashlib.sha1(f"{digest}:{target}".encode('utf-8')).hexdigest())
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response.make_conditional(request)
+
+@app.route('/map_status/<digest>.<ext>')
+def map_status(digest, ext):
+    """
+    Reports whether a map is ready to be served without waiting. A map that is neither ready
+    nor pending (e.g. its background render was rejected) is rendered when its URL is requested.
+    """
+    response = jsonify({"ready": render_cache.is_ready(digest, ext), "pending": render_cache.is_pending(digest)})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/map/<digest>.<ext>')
+def serve_map(digest, ext):
+    """
+    Serves a rendered map from the render cache. The URL is derived from the map's content,
+    so responses are marked immutable and carry the digest as a strong ETag.
+    A digest this process has never seen is rendered from the URL's ?bbox=&sel= view, as long
+    as those (with the current relations of the selected country) hash to the same digest. If
+    they hash to another digest (the country's relations changed since the URL was issued), the
+    request is redirected to the current map of that view.
+    """
+    if ext not in IMAGE_MIMETYPES:
+        abort(404)
+    data = render_cache.get(digest, ext)
+    if data is None and 'bbox' in request.args:
+        try:
+            extent = bbox_to_extent(parse_floats(request.args['bbox'], 4, 'bbox'))
+        except ValueError:
+            abort(400)
+        graph = relation_graph
+        selected_iso = request.args.get('sel') or None
+        if selected_iso:
+            allies_iso, enemies_iso = graph.relations(selected_iso)
+            data_version = graph.country_version(selected_iso)
+        else:
+            allies_iso = enemies_iso = ()
+            data_version = None
+        current_digest = render_cache_key(extent, selected_iso, allies_iso, enemies_iso, ext, data_version)
+        if current_digest != digest:
+            # Pages and cached /view responses still link to maps from before a relations reload
+            if selected_iso and selected_iso not in graph.ids and selected_iso not in _country_geometries \
+                    and selected_iso not in get_geometry_level(resolution_for_extent(extent))["countries"]:
+                abort(404)
+            response = redirect(map_image_url(current_digest, extent, selected_iso, ext))
+            response.headers['Cache-Control'] = 'no-cache' # The target moves again on the next edit
+            return response
+        if render_cache.get_or_render(extent, selected_iso, allies_iso, enemies_iso, ext, data_version) is not None:
+            data = render_cache.get(digest, ext)
+    if data is None:
+        abort(404)
+    response = Response(data, mimetype=IMAGE_MIMETYPES[ext])
+    response.set_etag(digest)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response.make_conditional(request)
 
 @app.route('/')
 def index():
     """
     Renders the main index.html page.
-    Initializes the map extent in the session if not present.
-    """
-    if 'current_extent' not in session:
-        session['current_extent'] = DEFAULT_EXTENT
-        print(f"Initialized session extent to: {session['current_extent']}")
-    
-    # Generate the initial default map using the current session extent
-    default_map_filename = 'world_map_default.png'
-    default_map_path = os.path.join(STATIC_FOLDER, default_map_filename)
-    
-    # Always regenerate the default map with the current session extent for robustness
-    generate_world_map_image(default_map_path, extent=session['current_extent'])
-    print(f"Ensured default map exists at {default_map_path} for initial load.")
-
-    return render_template('index.html', initial_map_url=url_for('static', filename=default_map_filename))
+    The view is held by the page itself; ?bbox=W,S,E,N&sel=ISO opens a specific /view.
+    """
+    try:
+        initial_extent = bbox_to_extent(parse_floats(request.args['bbox'], 4, 'bbox')) if 'bbox' in request.args else DEFAULT_EXTENT
+    except ValueError:
+        initial_extent = DEFAULT_EXTENT
+    initial_sel = request.args.get('sel') or None
+
+    # ?mode=vector renders the map in the browser from the vector assets, so no image is needed
+    map_mode = 'vector' if request.args.get('mode') == 'vector' else 'raster'
+    if map_mode == 'vector':
+        initial_map_url = ''
+    else:
+        # Serve the default map for the initial extent, which is pinned in the render cache once
+        # warm; other extents are rendered only on a cache miss.
+        # A selected country is applied by the page through /view once it has loaded.
+        initial_map_url = cached_map_url(initial_extent)
+        logger.debug("Serving initial map %s", initial_map_url, extra={"extent": initial_extent})
+
+    return render_template(
+        'index.html',
+        initial_map_url=initial_map_url,
+        initial_view={"bbox": [initial_extent[0], initial_extent[2], initial_extent[1], initial_extent[3]], "sel": initial_sel},
+        map_mode=map_mode,
+        vector_config={
+            "default_extent": DEFAULT_EXTENT,
+            "min_zoom_width": MIN_ZOOM_WIDTH,
+            "min_zoom_height": MIN_ZOOM_HEIGHT,
+            "level_min_widths": [level["min_extent_width"] for level in VECTOR_LEVELS],
+            "tile_url": url_for('geodetic_map_tile', z=0, x=0, y=0).rsplit('/', 3)[0], # .../tiles/4326
+            "tile_size": TILE_SIZE,
+            "max_tile_zoom": MAX_TILE_ZOOM,
+            "colors": {
+                "default": DEFAULT_COUNTRY_COLOR,
+                "selected": SELECTED_COUNTRY_COLOR,
+                "ally": ALLY_COUNTRY_COLOR,
+                "enemy": ENEMY_COUNTRY_COLOR,
+            },
+        },
+    )
+
+def view_transform(extent, digest=None):
+    """
+    Returns the MapTransform of the map displayed for extent: the one recorded when the image
+    `digest` was rendered in this process if known, otherwise one computed from the map layout.
+    """
+    transform = render_cache.transform(digest) if digest else None
+    return transform or compute_map_transform(quantize_extent(extent))
+
+def pixel_to_lonlat(extent, x, y, img_width, img_height, transform=None):
+    """
+    Converts a pixel on the map image displayed at img_width x img_height into (lon, lat).
+    x and y may also be NumPy arrays to convert many pixels at once.
+    """
+    transform = transform or view_transform(extent)
+    return transform.pixels_to_lonlat(x, y, (img_width, img_height))
 
 @app.route('/click_map', methods=['POST'])
 def click_map():
@@ -301,76 +1890,50 @@ def click_map():
 
     # Retrieve current extent from session to ensure click coordinates are relative to current view
     current_extent = session.get('current_extent', DEFAULT_EXTENT)
-    lon_min, lon_max, lat_min, lat_max = current_extent
-
-    # Define the original map dimensions from matplotlib fig.figsize and dpi
-    original_map_width_px = 10 * 100 # figsize width * dpi
-    original_map_height_px = 7 * 100 # figsize height * dpi
-
-    # Scale the click coordinates from the client image dimensions to the original map dimensions
-    scaled_x = (client_x / client_img_width) * original_map_width_px
-    scaled_y = (client_y / client_img_height) * original_map_height_px
-
-    # Convert pixel coordinates to longitude and latitude within the current extent
-    # Calculate the current geographic width and height of the displayed map
-    current_lon_range = lon_max - lon_min
-    current_lat_range = lat_max - lat_min
 
-    clicked_lon = lon_min + (scaled_x / original_map_width_px) * current_lon_range
-    clicked_lat = lat_max - (scaled_y / original_map_height_px) * current_lat_range # Y-axis inverted for lat
+    clicked_lon, clicked_lat = pixel_to_lonlat(current_extent, client_x, client_y, client_img_width, client_img_height)
 
-    print(f"Clicked pixel: ({client_x}, {client_y}) on displayed image ({client_img_width}x{client_img_height})")
-    print(f"Scaled pixel: ({scaled_x}, {scaled_y}) on original map ({original_map_width_px}x{original_map_height_px})")
-    print(f"Converted Lat/Lon: ({clicked_lat}, {clicked_lon}) within extent {current_extent}")
+    logger.debug("Map clicked", extra={"pixel": (client_x, client_y), "image_size": (client_img_width, client_img_height),
+                                       "lonlat": (clicked_lon, clicked_lat), "extent": current_extent})
 
-    clicked_point = Point(clicked_lon, clicked_lat)
-
-    selected_country_iso = None
     selected_country_name = "None"
     allies_names = []
     enemies_names = []
 
-    # Iterate through pre-loaded country geometries to find which one contains the clicked point
-    for iso, country_data in _country_geometries.items():
-        geom = country_data['geometry']
-        if geom.contains(clicked_point):
-            selected_country_iso = iso
-            selected_country_name = country_data['name'] # Use name from geometry data
-            break
+    # Look up the country containing the clicked point via the spatial index, using the
+    # same level of detail the current view was rendered with
+    resolution = resolution_for_extent(current_extent)
+    with timed_stage('country_lookup'):
+        selected_country_iso = find_country_at(clicked_lon, clicked_lat, resolution)
+    if selected_country_iso:
+        level_countries = get_geometry_level(resolution)["countries"]
+        selected_country_name = level_countries[selected_country_iso]['name'] # Use name from geometry data
 
     if selected_country_iso:
-        country_info = geopolitical_data.get(selected_country_iso, geopolitical_data["DEFAULT"])
-        allies_iso = country_info.get('allies', [])
-        enemies_iso = country_info.get('enemies', [])
-        
-        # Convert ISO codes of allies/enemies to their full names for display
-        allies_names = [geopolitical_data.get(iso, {}).get('name', iso) for iso in allies_iso]
-        enemies_names = [geopolitical_data.get(iso, {}).get('name', iso) for iso in enemies_iso]
-        
-        # Generate a new map image with the selected country and its relations colored
-        colored_map_filename = f"world_map_{selected_country_iso}_{os.urandom(4).hex()}.png"
-        colored_map_path = os.path.join(STATIC_FOLDER, colored_map_filename)
+        # Hold on to one graph for the whole request in case the relations file is reloaded meanwhile
+        graph = relation_graph
+        allies_iso, enemies_iso = graph.relations(selected_country_iso)
+
+        # Full names of allies/enemies for display are precomputed in the relation graph
+        allies_names, enemies_names = (list(names) for names in graph.relation_names(selected_country_iso))
         
-        generate_world_map_image(
-            image_path=colored_map_path,
+        # Get a map image with the selected country and its relations colored (cached per view)
+        map_url = cached_map_url(
             extent=current_extent, # Use the current zoom extent for the new map
             selected_iso=selected_country_iso,
             allies_iso_list=allies_iso,
-            enemies_iso_list=enemies_iso
+            enemies_iso_list=enemies_iso,
+            data_version=graph.country_version(selected_country_iso)
         )
-        map_url = url_for('static', filename=colored_map_filename)
-        print(f"Map updated for {selected_country_name}, URL: {map_url}")
+        logger.debug("Map updated for %s", selected_country_name, extra={"map_url": map_url})
 
     else:
-        # If no country was clicked (e.g., clicked on ocean), reset info and provide a fresh map (default colors)
-        temp_map_filename = f"world_map_default_current_zoom_{os.urandom(4).hex()}.png" # Unique filename for a fresh map
-        temp_map_path = os.path.join(STATIC_FOLDER, temp_map_filename) # Full path to save the image
-        generate_world_map_image(temp_map_path, extent=current_extent) # Regenerate default colors with current zoom
-        map_url = url_for('static', filename=temp_map_filename) # Generate URL for the frontend
+        # If no country was clicked (e.g., clicked on ocean), reset info and provide a map with default colors
+        map_url = cached_map_url(extent=current_extent) # Default colors with current zoom
         selected_country_name = "None"
         allies_names = ["None listed"]
         enemies_names = ["None listed"]
-        print("No country clicked. Reverting to default map colors at current zoom.")
+        logger.debug("No country clicked. Reverting to default map colors at current zoom.")
 
     response_data = {
         "name": selected_country_name,
@@ -380,47 +1943,19 @@ def click_map():
     }
     return jsonify(response_data)
 
-@app.route('/zoom_to_rect', methods=['POST'])
-def zoom_to_rect():
+def compute_zoom_extent(current_extent, x1, y1, x2, y2, img_width, img_height, transform=None):
     """
-    API endpoint to handle rectangle zoom, calculate new extent,
-    and return a new map image URL.
+    Converts a rectangle drawn on the map image displayed at img_width x img_height into a new
+    geographic extent, clamped to the globe and no smaller than MIN_ZOOM_WIDTH x MIN_ZOOM_HEIGHT.
+    transform defaults to the MapTransform of the current extent.
     """
-    data = request.json
-    x1, y1 = data.get('x1'), data.get('y1')
-    x2, y2 = data.get('x2'), data.get('y2')
-    img_width = data.get('img_width')
-    img_height = data.get('img_height')
-
-    if None in [x1, y1, x2, y2, img_width, img_height]:
-        return jsonify({"error": "Missing rectangle coordinates or image dimensions"}), 400
-
-    current_extent = session.get('current_extent', DEFAULT_EXTENT)
-    lon_min_curr, lon_max_curr, lat_min_curr, lat_max_curr = current_extent
-
-    # Original map dimensions used for generation
-    original_map_width_px = 10 * 100
-    original_map_height_px = 7 * 100
-
-    # Scale client rectangle coordinates to original map dimensions
-    scaled_x1 = (x1 / img_width) * original_map_width_px
-    scaled_y1 = (y1 / img_height) * original_map_height_px
-    scaled_x2 = (x2 / img_width) * original_map_width_px
-    scaled_y2 = (y2 / img_height) * original_map_height_px
-
-    # Convert scaled pixel coordinates to new geographic extent
-    # Lon range maps to X axis, Lat range maps to Y axis (inverted)
-    current_lon_range = lon_max_curr - lon_min_curr
-    current_lat_range = lat_max_curr - lat_min_curr
-
-    # Calculate new min/max longitudes and latitudes based on the selected rectangle
-    # The new longitude is scaled from the current longitude range
-    new_lon_min = lon_min_curr + (scaled_x1 / original_map_width_px) * current_lon_range
-    new_lon_max = lon_min_curr + (scaled_x2 / original_map_width_px) * current_lon_range
-
-    # The new latitude is scaled from the current latitude range, remembering Y is inverted
-    new_lat_max = lat_max_curr - (scaled_y1 / original_map_height_px) * current_lat_range
-    new_lat_min = lat_max_curr - (scaled_y2 / original_map_height_px) * current_lat_range
+    # Convert the rectangle's corners to geographic coordinates (pixel rows grow downwards)
+    transform = transform or view_transform(current_extent)
+    lons, lats = transform.pixels_to_lonlat([x1, x2], [y1, y2], (img_width, img_height))
+    if not (np.isfinite(lons).all() and np.isfinite(lats).all()):
+        raise ValueError("Zoom rectangle extends beyond the map projection")
+    new_lon_min, new_lon_max = float(lons[0]), float(lons[1])
+    new_lat_max, new_lat_min = float(lats[0]), float(lats[1])
 
     new_extent = [new_lon_min, new_lon_max, new_lat_min, new_lat_max]
 
@@ -433,7 +1968,7 @@ def zoom_to_rect():
     # Prevent extremely small zooms that might cause rendering issues or bad UX
     if (new_extent[1] - new_extent[0] < MIN_ZOOM_WIDTH) or \
        (new_extent[3] - new_extent[2] < MIN_ZOOM_HEIGHT):
-        print("Zoom rectangle too small. Adjusting to minimum zoom width/height.")
+        logger.debug("Zoom rectangle too small. Adjusting to minimum zoom width/height.")
         # Re-center the new extent to ensure it's not off-screen if user dragged too small
         center_lon = (new_extent[0] + new_extent[1]) / 2
         center_lat = (new_extent[2] + new_extent[3]) / 2
@@ -449,18 +1984,39 @@ def zoom_to_rect():
         new_extent[2] = max(new_extent[2], -90)
         new_extent[3] = min(new_extent[3], 90)
 
+    return new_extent
 
+@app.route('/zoom_to_rect', methods=['POST'])
+def zoom_to_rect():
+    """
+    API endpoint to handle rectangle zoom, calculate new extent,
+    and return a new map image URL.
+    """
+    data = request.json
+    x1, y1 = data.get('x1'), data.get('y1')
+    x2, y2 = data.get('x2'), data.get('y2')
+    img_width = data.get('img_width')
+    img_height = data.get('img_height')
+
+    if None in [x1, y1, x2, y2, img_width, img_height]:
+        return jsonify({"error": "Missing rectangle coordinates or image dimensions"}), 400
+
+    current_extent = session.get('current_extent', DEFAULT_EXTENT)
+    with timed_stage('extent_math'):
+        new_extent = compute_zoom_extent(current_extent, x1, y1, x2, y2, img_width, img_height)
+
+    # Snap to the cache grid so later clicks are converted against the extent actually rendered
+    new_extent = quantize_extent(new_extent)
     session['current_extent'] = new_extent
-    print(f"Zoomed to rectangle. New extent: {new_extent}")
+    logger.debug("Zoomed to rectangle", extra={"extent": new_extent})
 
-    # Generate a new map image with the updated extent
-    zoomed_map_filename = f"world_map_zoomed_{os.urandom(4).hex()}.png"
-    zoomed_map_path = os.path.join(STATIC_FOLDER, zoomed_map_filename)
-    generate_world_map_image(zoomed_map_path, extent=new_extent)
+    # Start rendering the updated extent and answer with a preview cropped from the current view
+    # (the session does not track the selection, so the uncolored current view is used)
+    urls = progressive_map_urls(new_extent, current_extent)
 
     # When zooming, reset country info as no specific country was clicked yet in new view
     return jsonify({
-        "map_url": url_for('static', filename=zoomed_map_filename),
+        **urls,
         "name": "None",
         "allies": [],
         "enemies": []
@@ -472,39 +2028,781 @@ def reset_view():
     API endpoint to reset the map view to the default global extent.
     """
     session['current_extent'] = DEFAULT_EXTENT
-    print("Resetting view to default global extent.")
+    logger.debug("Resetting view to default global extent.")
 
-    # Generate a new default map image
-    reset_map_filename = f"world_map_reset_{os.urandom(4).hex()}.png"
-    reset_map_path = os.path.join(STATIC_FOLDER, reset_map_filename)
-    generate_world_map_image(reset_map_path, extent=DEFAULT_EXTENT)
+    # Get the default global map, which is almost always already cached
+    map_url = cached_map_url(extent=DEFAULT_EXTENT)
 
     return jsonify({
-        "map_url": url_for('static', filename=reset_map_filename),
+        "map_url": map_url,
         "name": "None",
         "allies": [],
         "enemies": []
     })
 
+# Stateless views. A view is fully described by its URL: bbox (west,south,east,north, snapped
+# to the EXTENT_QUANTUM grid) plus an optional selected country, so identical views produce
+# identical responses that browsers and shared caches can store. Clicks and zooms are expressed
+# relative to the view they happened on and answered with the canonical URL of the next view.
+VIEW_MAX_AGE = int(os.environ.get('VIEW_MAX_AGE', 300)) # Seconds shared caches may reuse a view response
 
-if __name__ == '__main__':
-    # Initial cleanup of the static folder once at app startup
-    print(f"Clearing contents of {STATIC_FOLDER} on app startup...")
-    for filename in os.listdir(STATIC_FOLDER):
-        file_path = os.path.join(STATIC_FOLDER, filename)
+def parse_floats(value, count, name):
+    """Parses a comma-separated list of exactly `count` finite numbers, raising ValueError otherwise."""
+    parts = value.split(',')
+    if len(parts) != count:
+        raise ValueError(f"{name} needs {count} comma-separated numbers")
+    numbers = [float(part) for part in parts]
+    if not all(math.isfinite(number) for number in numbers):
+        raise ValueError(f"{name} must be finite")
+    return numbers
+
+def bbox_to_extent(bbox):
+    """Converts a west,south,east,north bbox into a quantized, globe-clamped [lon_min, lon_max, lat_min, lat_max] extent."""
+    west, south, east, north = bbox
+    extent = [max(west, -180), min(east, 180), max(south, -90), min(north, 90)]
+    if extent[0] >= extent[1] or extent[2] >= extent[3]:
+        raise ValueError("bbox must have west < east and south < north within the globe")
+    return quantize_extent(extent)
+
+def view_digest(extent, selected_iso=None, graph=None):
+    """Returns the render cache digest of the map displayed for a view (extent and selected country)."""
+    graph = graph or relation_graph
+    if not selected_iso:
+        return render_cache_key(extent, image_format=MAP_IMAGE_FORMAT)
+    allies_iso, enemies_iso = graph.relations(selected_iso)
+    return render_cache_key(extent, selected_iso, allies_iso, enemies_iso, MAP_IMAGE_FORMAT, graph.country_version(selected_iso))
+
+def view_url(extent, selected_iso=None):
+    """Returns the canonical /view URL for an extent and optional selected country."""
+    if selected_iso:
+        return url_for('view', bbox=extent_to_bbox(extent), sel=selected_iso)
+    return url_for('view', bbox=extent_to_bbox(extent))
+
+@app.route('/view')
+def view():
+    """
+    Stateless API endpoint describing a map view: GET /view?bbox=W,S,E,N&sel=ISO.
+    Optional `click=x,y` or `rect=x1,y1,x2,y2` (with `size=w,h`, the displayed image size)
+    apply a click or a rectangle zoom to that view. Responses are deterministic JSON with the
+    resulting bbox, selection, relations, map URL and canonical view URL. Zooms answer without
+    waiting for the render and add preview_url and status_url (see progressive_map_urls).
+    """
+    parent = None # (extent, selected country) of the view a zoom started from
+    try:
+        extent = bbox_to_extent(parse_floats(request.args.get('bbox', '-180,-90,180,90'), 4, 'bbox'))
+        selected_iso = request.args.get('sel') or None
+
+        if 'click' in request.args or 'rect' in request.args:
+            img_width, img_height = parse_floats(request.args.get('size', ''), 2, 'size')
+            if img_width <= 0 or img_height <= 0:
+                raise ValueError("size must be positive")
+            # Pixels refer to the image displayed for the view the action happened on
+            transform = view_transform(extent, view_digest(extent, selected_iso))
+            if 'click' in request.args:
+                x, y = parse_floats(request.args['click'], 2, 'click')
+                lon, lat = pixel_to_lonlat(extent, x, y, img_width, img_height, transform)
+                with timed_stage('country_lookup'):
+                    selected_iso = find_country_at(lon, lat, resolution_for_extent(extent))
+            else:
+                x1, y1, x2, y2 = parse_floats(request.args['rect'], 4, 'rect')
+                parent = (extent, selected_iso)
+                with timed_stage('extent_math'):
+                    extent = quantize_extent(compute_zoom_extent(
+                        extent, min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2), img_width, img_height, transform))
+                selected_iso = None # A zoomed view starts without a selection
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Hold on to one graph for the whole request in case the relations file is reloaded meanwhile
+    graph = relation_graph
+    # Zoomed views hit-test against the 50m/10m levels, which have countries the 110m level lacks
+    level_countries = get_geometry_level(resolution_for_extent(extent))["countries"]
+    if (selected_iso is not None and selected_iso not in level_countries
+            and selected_iso not in _country_geometries and selected_iso not in graph.ids):
+        return jsonify({"error": f"Unknown country {selected_iso}"}), 404
+
+    if selected_iso:
+        allies_iso, enemies_iso = graph.relations(selected_iso)
+        allies_names, enemies_names = (list(names) for names in graph.relation_names(selected_iso))
+        if selected_iso in level_countries:
+            name = level_countries[selected_iso]['name']
+        elif selected_iso in _country_geometries:
+            name = _country_geometries[selected_iso]['name']
+        else:
+            name = graph.name(selected_iso)
+        map_url = cached_map_url(extent, selected_iso, allies_iso, enemies_iso,
+                                 data_version=graph.country_version(selected_iso))
+    else:
+        allies_iso = enemies_iso = ()
+        allies_names, enemies_names = [], []
+        name = "None"
+        map_url = None if parent else cached_map_url(extent)
+
+    progressive = {}
+    if parent:
+        parent_extent, parent_iso = parent
+        parent_allies, parent_enemies = graph.relations(parent_iso) if parent_iso else ((), ())
+        progressive = progressive_map_urls(
+            extent, parent_extent, (parent_iso, parent_allies, parent_enemies),
+            parent_data_version=graph.country_version(parent_iso) if parent_iso else None)
+        map_url = progressive.pop("map_url")
+
+    payload = {
+        **progressive,
+        "bbox": [extent[0], extent[2], extent[1], extent[3]],
+        "sel": selected_iso,
+        "name": name,
+        "allies": allies_names,
+        "enemies": enemies_names,
+        "allies_iso": list(allies_iso),
+        "enemies_iso": list(enemies_iso),
+        "map_url": map_url,
+        "view_url": view_url(extent, selected_iso),
+    }
+    body = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    response = Response(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body.encode('utf-8')).hexdigest())
+    if map_url == fallback_map_url():
+        response.headers['Cache-Control'] = 'no-store' # A failed render must not be cached downstream
+    else:
+        response.headers['Cache-Control'] = f'public, max-age={VIEW_MAX_AGE}'
+    return response.make_conditional(request)
+
+# Bulk lookups. Analytics jobs resolve event feeds of many points in one request; points go
+# through the same vectorized conversion and STRtree query as single clicks, and relation
+# summaries are returned once per distinct country rather than once per point.
+LOOKUP_MAX_POINTS = int(os.environ.get('LOOKUP_MAX_POINTS', 100000))
+
+def read_lookup_points():
+    """
+    Reads the points of a /api/lookup request as an (N, 2) float array plus an optional
+    (extent, (img_width, img_height)) when the points are pixels. Raises ValueError on bad input.
+    """
+    if request.mimetype in ('application/octet-stream', 'application/x-npy'):
+        if request.mimetype == 'application/x-npy':
+            coords = np.load(io.BytesIO(request.get_data()), allow_pickle=False)
+        else:
+            body = request.get_data()
+            if len(body) % 16:
+                raise ValueError("binary body must hold (x, y) float64 pairs")
+            coords = np.frombuffer(body, dtype='<f8').reshape(-1, 2)
+        pixels = 'size' in request.args
+        bbox = request.args.get('bbox', '-180,-90,180,90')
+        size = request.args.get('size')
+        resolution = request.args.get('resolution')
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise ValueError("expected a JSON object or a float64 binary body")
+        pixels = 'pixels' in data
+        if pixels:
+            coords = data['pixels']
+        elif 'points' in data:
+            coords = data['points']
+        else:
+            coords = np.column_stack([np.asarray(data.get('lons', []), dtype=float),
+                                      np.asarray(data.get('lats', []), dtype=float)])
+        bbox = ','.join(str(value) for value in data.get('bbox', [-180, -90, 180, 90]))
+        size = ','.join(str(value) for value in data['size']) if 'size' in data else None
+        resolution = data.get('resolution')
+
+    coords = np.asarray(coords, dtype=float)
+    if coords.size == 0:
+        coords = coords.reshape(0, 2)
+    if coords.ndim != 2 or coords.shape[1] != 2:
+        raise ValueError("points must be (x, y) pairs")
+    if len(coords) > LOOKUP_MAX_POINTS:
+        raise OverflowError(f"at most {LOOKUP_MAX_POINTS} points per request")
+    if not np.isfinite(coords).all():
+        raise ValueError("coordinates must be finite")
+    view = None
+    if pixels:
+        if size is None:
+            raise ValueError("pixel coordinates need the displayed image size")
+        img_width, img_height = parse_floats(size, 2, 'size')
+        if img_width <= 0 or img_height <= 0:
+            raise ValueError("size must be positive")
+        view = (bbox_to_extent(parse_floats(bbox, 4, 'bbox')), (img_width, img_height))
+    if resolution is not None and resolution not in {res for res, _ in GEOMETRY_LEVELS}:
+        raise ValueError(f"unknown resolution {resolution}")
+    return coords, view, resolution
+
+@app.route('/api/lookup', methods=['POST'])
+def bulk_lookup():
+    """
+    API endpoint resolving many points to countries in one request. Points are sent as JSON
+    ({"points": [[lon, lat], ...]}, {"lons": [...], "lats": [...]}, or {"pixels": [[x, y], ...],
+    "bbox": [W, S, E, N], "size": [w, h]}) or as a binary body of float64 (x, y) pairs
+    (application/octet-stream, or a .npy array as application/x-npy) with ?bbox=&size= for pixels.
+    Returns one ISO code (or null) per point and a relation summary per distinct country.
+    """
+    try:
+        coords, view, resolution = read_lookup_points()
+    except OverflowError as e:
+        return jsonify({"error": str(e)}), 413
+    except (ValueError, TypeError, KeyError, EOFError) as e:
+        return jsonify({"error": f"Invalid lookup request: {e}"}), 400
+
+    with timed_stage('bulk_lookup'):
+        if view is not None:
+            extent, (img_width, img_height) = view
+            lons, lats = pixel_to_lonlat(extent, coords[:, 0], coords[:, 1], img_width, img_height)
+            resolution = resolution or resolution_for_extent(extent)
+        else:
+            lons, lats = coords[:, 0], coords[:, 1]
+        isos = find_countries_at(lons, lats, resolution or '110m')
+
+    # Hold on to one graph for the whole request in case the relations file is reloaded meanwhile
+    graph = relation_graph
+    countries = {}
+    for iso in set(isos) - {None}:
+        allies, enemies = graph.relations(iso)
+        countries[iso] = {
+            "name": _country_geometries[iso]['name'] if iso in _country_geometries else graph.name(iso),
+            "allies": list(allies),
+            "enemies": list(enemies),
+        }
+    return jsonify({
+        "count": len(isos),
+        "matched": len(isos) - isos.count(None),
+        "isos": isos,
+        "countries": countries,
+    })
+
+@app.route('/cache_stats')
+def cache_stats():
+    """
+    API endpoint exposing render cache hit/miss counters and usage, render service
+    queue depth and latency, and the loaded relations data version.
+    """
+    return jsonify({
+        "render_cache": render_cache.stats(),
+        "render_service": render_service.stats(),
+        "relations": {"path": RELATIONS_DATA_PATH, "version": relation_graph.version, "countries": len(relation_graph.versions)},
+    })
+
+
+# Slippy-map tile configuration. Tiles show the base (uncolored) map and come in two XYZ
+# pyramids: standard Web Mercator tiles for external slippy-map clients, and PlateCarree
+# (EPSG:4326) tiles that the page's vector mode uses as its base layer, drawing only the colored
+# countries itself. Geodetic zoom z has 2^(z+1) x 2^z tiles of 180/2^z degrees each. Tiles are
+# rendered once through the render service and kept on disk.
+TILE_SIZE = 256 # Tile width and height in pixels
+MAX_TILE_ZOOM = int(os.environ.get('MAX_TILE_ZOOM', 8))
+TILE_CACHE_FOLDER = os.environ.get('TILE_CACHE_FOLDER', os.path.join(os.path.dirname(__file__), 'tile_cache'))
+WEB_MERCATOR_HALF_WORLD = 20037508.342789244 # Half the Web Mercator world width in meters
+
+def tile_bounds(z, x, y):
+    """Returns the Web Mercator bounds [x_min, x_max, y_min, y_max] (meters) of tile z/x/y."""
+    tile_span = 2 * WEB_MERCATOR_HALF_WORLD / (2 ** z)
+    x_min = -WEB_MERCATOR_HALF_WORLD + x * tile_span
+    y_max = WEB_MERCATOR_HALF_WORLD - y * tile_span
+    return [x_min, x_min + tile_span, y_max - tile_span, y_max]
+
+def tile_lonlat_bounds(z, x, y, geodetic=False):
+    """Returns the geographic bounds [lon_min, lon_max, lat_min, lat_max] of tile z/x/y."""
+    if geodetic:
+        span = 180.0 / (2 ** z)
+        return [-180.0 + x * span, -180.0 + (x + 1) * span, 90.0 - (y + 1) * span, 90.0 - y * span]
+    n = 2 ** z
+    lon_min = x / n * 360.0 - 180.0
+    lon_max = (x + 1) / n * 360.0 - 180.0
+    lat_max = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    lat_min = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return [lon_min, lon_max, lat_min, lat_max]
+
+def tile_exists(z, x, y, geodetic=False):
+    """Whether z/x/y is a tile of the (Web Mercator or geodetic) pyramid within MAX_TILE_ZOOM."""
+    columns = 2 ** (z + 1) if geodetic else 2 ** z
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < columns and 0 <= y < 2 ** z
+
+def tile_path(z, x, y, geodetic=False):
+    folder = os.path.join(TILE_CACHE_FOLDER, '4326') if geodetic else TILE_CACHE_FOLDER
+    return os.path.join(folder, str(z), str(x), f"{y}.png")
+
+def render_tile_bytes(z, x, y, geodetic=False):
+    """
+    Render job: renders a single TILE_SIZE x TILE_SIZE base-map tile from the country geometries
+    and returns it PNG-encoded, or None on failure. Only countries intersecting the tile are
+    drawn, at the level of detail for its width.
+    """
+    try:
+        if geodetic:
+            projection, bounds = ccrs.PlateCarree(), tile_lonlat_bounds(z, x, y, geodetic=True)
+        else:
+            projection, bounds = ccrs.Mercator.GOOGLE, tile_bounds(z, x, y)
+        fig = plt.Figure(figsize=(TILE_SIZE / 100, TILE_SIZE / 100), dpi=100)
+        ax = fig.add_axes([0, 0, 1, 1], projection=projection) # Fill the whole tile, no padding
+        ax.set_extent(bounds, crs=projection)
+        ax.spines['geo'].set_visible(False)
+
+        visible_geoms = [geom for _, geom in visible_countries(tile_lonlat_bounds(z, x, y, geodetic))]
+        if visible_geoms:
+            ax.add_geometries(visible_geoms, ccrs.PlateCarree(),
+                              facecolor=DEFAULT_COUNTRY_COLOR, edgecolor='white', linewidth=0.5, zorder=1)
+
+        fig.set_facecolor('#e0f2fe') # Ocean color shows wherever no country is drawn
+        ax.set_facecolor('#e0f2fe')
+
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png', dpi=100)
+        plt.close(fig)
+        return buffer.getvalue()
+    except Exception as e:
+        logger.exception("Error generating tile %d/%d/%d: %s", z, x, y, e)
+        return None
+
+def get_or_render_tile(z, x, y, force=False, geodetic=False):
+    """
+    Returns the on-disk path of tile z/x/y, rendering it through the render service on first
+    request. None on failure; raises RenderQueueFull when the render service is saturated.
+    """
+    path = tile_path(z, x, y, geodetic)
+    if os.path.exists(path) and not force:
+        return path
+    key = f"tile:{'4326' if geodetic else '3857'}/{z}/{x}/{y}"
+    data = render_service.run(key, render_tile_bytes, z, x, y, geodetic)
+    if not data:
+        return None
+    # write_image_file replaces the tile atomically, so concurrent requests never read a partial tile
+    write_image_file(path, data)
+    return path
+
+def tile_response(z, x, y, geodetic=False):
+    if not tile_exists(z, x, y, geodetic):
+        abort(404)
+    path = get_or_render_tile(z, x, y, geodetic=geodetic)
+    if path is None:
+        abort(500)
+    response = send_file(path, mimetype='image/png', conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def map_tile(z, x, y):
+    """
+    Serves an XYZ Web Mercator base-map tile. Tiles never change once rendered, so they are
+    marked immutable for browsers and CDNs.
+    """
+    return tile_response(z, x, y)
+
+@app.route('/tiles/4326/<int:z>/<int:x>/<int:y>.png')
+def geodetic_map_tile(z, x, y):
+    """Serves a PlateCarree (EPSG:4326) base-map tile, as used by the page's vector mode."""
+    return tile_response(z, x, y, geodetic=True)
+
+@app.cli.command('seed-tiles')
+@click.option('--min-zoom', default=0, show_default=True, help='First zoom level to render.')
+@click.option('--max-zoom', default=4, show_default=True, help='Last zoom level to render (inclusive).')
+@click.option('--force', is_flag=True, help='Re-render tiles that already exist on disk.')
+@click.option('--geodetic', is_flag=True, help='Seed the PlateCarree (EPSG:4326) pyramid used by the page.')
+def seed_tiles(min_zoom, max_zoom, force, geodetic):
+    """Pre-renders the tile pyramid for zoom levels MIN_ZOOM..MAX_ZOOM into the tile cache."""
+    max_zoom = min(max_zoom, MAX_TILE_ZOOM)
+
+    def seed(tile):
         try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
+            return get_or_render_tile(*tile, force=force, geodetic=geodetic) is not None
+        except RenderQueueFull:
+            return False
+
+    # One tile per render worker at a time, so the tiles render in parallel without filling the queue
+    with ThreadPoolExecutor(max_workers=max(1, render_service.max_workers)) as threads:
+        for z in range(min_zoom, max_zoom + 1):
+            columns = 2 ** (z + 1) if geodetic else 2 ** z
+            tiles = [(z, x, y) for x in range(columns) for y in range(2 ** z)]
+            results = list(threads.map(seed, tiles))
+            click.echo(f"Zoom {z}: {results.count(True)} tiles ready, {results.count(False)} failed")
+
+
+# Client-side vector mode. Country geometries are simplified and coordinate-quantized per
+# level of detail, serialized to GeoJSON once at startup, and precompressed so requests only
+# pick a pre-built body. Level 0 is used for the global view, higher levels for zoomed views;
+# a level applies while the visible longitude range is at least its min_extent_width.
+VECTOR_LEVELS = [
+    {"tolerance": 0.5, "precision": 2, "min_extent_width": 120},
+    {"tolerance": 0.1, "precision": 3, "min_extent_width": 30},
+    {"tolerance": 0.02, "precision": 4, "min_extent_width": 0},
+]
+VECTOR_ASSET_MAX_AGE = 24 * 60 * 60 # Seconds browsers may reuse an asset before revalidating
+_vector_assets = {} # asset name -> {"identity": bytes, "gzip": bytes, "br": bytes or None, "etag": str}
+
+def make_vector_asset(payload, mimetype):
+    """Precompresses a serialized payload and computes its strong ETag."""
+    return {
+        "mimetype": mimetype,
+        "identity": payload,
+        "gzip": gzip.compress(payload, compresslevel=9),
+        "br": brotli.compress(payload) if brotli is not None else None,
+        "etag": hashlib.sha1(payload).hexdigest(),
+    }
+
+def build_country_geojson(tolerance, precision):
+    """Serializes _country_geometries as a simplified, quantized GeoJSON FeatureCollection."""
+    features = []
+    for iso_a3, data in _country_geometries.items():
+        geom = data['geometry'].simplify(tolerance, preserve_topology=True)
+        geom = shapely.transform(geom, lambda coords: np.round(coords, precision))
+        if geom.is_empty:
+            continue
+        features.append({
+            "type": "Feature",
+            "properties": {"iso": iso_a3, "name": data['name']},
+            "geometry": mapping(geom),
+        })
+    collection = {"type": "FeatureCollection", "features": features}
+    return json.dumps(collection, separators=(',', ':')).encode('utf-8')
+
+def build_relations_json():
+    """Serializes geopolitical_data (without the DEFAULT fallback) as compact JSON."""
+    relations = {iso: info for iso, info in geopolitical_data.items() if iso != "DEFAULT"}
+    return json.dumps(relations, separators=(',', ':')).encode('utf-8')
+
+def build_vector_assets():
+    """Builds all vector-mode payloads. Called once at startup after geometries are loaded."""
+    for level, settings in enumerate(VECTOR_LEVELS):
+        payload = build_country_geojson(settings["tolerance"], settings["precision"])
+        _vector_assets[f"countries_{level}"] = make_vector_asset(payload, 'application/geo+json')
+    _vector_assets["relations"] = make_vector_asset(build_relations_json(), 'application/json')
+    logger.info("Built %d vector assets.", len(_vector_assets))
+
+build_vector_assets()
+
+def vector_asset_response(name):
+    """
+    Serves a precomputed vector asset, honoring If-None-Match and choosing the best
+    precompressed encoding the client accepts.
+    """
+    asset = _vector_assets.get(name)
+    if asset is None:
+        abort(404)
+
+    if request.if_none_match.contains(asset["etag"]):
+        response = Response(status=304)
+    else:
+        if asset["br"] is not None and request.accept_encodings['br']:
+            body, encoding = asset["br"], 'br'
+        elif request.accept_encodings['gzip']:
+            body, encoding = asset["gzip"], 'gzip'
+        else:
+            body, encoding = asset["identity"], None
+        response = Response(body, mimetype=asset["mimetype"])
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(asset["etag"])
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f'public, max-age={VECTOR_ASSET_MAX_AGE}'
+    return response
+
+@app.route('/api/countries.geojson')
+def countries_geojson():
+    """
+    API endpoint serving simplified country geometries for client-side rendering.
+    The `level` query parameter selects the level of detail (see VECTOR_LEVELS).
+    """
+    level = request.args.get('level', 0, type=int)
+    return vector_asset_response(f"countries_{level}")
+
+@app.route('/api/relations.json')
+def relations_json():
+    """
+    API endpoint serving the geopolitical relations used to color the map client-side.
+    """
+    return vector_asset_response("relations")
+
+
+# Hot reloading of the relations file. Each worker process checks the file's modification time
+# at most every RELATIONS_RELOAD_INTERVAL seconds, before handling a request. A changed file is
+# parsed and compiled completely before the module globals are swapped, so requests see either
+# the old or the new data, never a mix; a file that fails to load leaves the old data in place.
+_relations_mtime = os.path.getmtime(RELATIONS_DATA_PATH)
+_relations_checked_at = time.monotonic()
+_relations_reload_lock = threading.Lock()
+
+def reload_relations(force=False):
+    """
+    Reloads the relations file if it changed since it was last loaded (or always if force).
+    Only cached maps of countries whose relations changed are invalidated; cache keys embed the
+    per-country data version, so other workers' stale entries are never served either.
+    Returns the set of changed country codes, or None if nothing was reloaded.
+    """
+    global geopolitical_data, relation_graph, _relations_mtime
+    with _relations_reload_lock:
+        try:
+            mtime = os.path.getmtime(RELATIONS_DATA_PATH)
+            if mtime == _relations_mtime and not force:
+                return None
+            data = read_relations_file(RELATIONS_DATA_PATH)
+            graph = RelationGraph(data, relation_known_codes())
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("Could not reload relations from %s, keeping the loaded data: %s", RELATIONS_DATA_PATH, e)
+            return None
+
+        changed = graph.changed_countries(relation_graph)
+        geopolitical_data, relation_graph = data, graph
+        _relations_mtime = mtime
+        _vector_assets["relations"] = make_vector_asset(build_relations_json(), 'application/json')
+        invalidated = render_cache.invalidate(changed)
+        # Re-warm the changed countries that still have relations data
+        rewarm = sorted(changed & set(graph.versions)) if _warmed else []
+
+    for issue in graph.issues:
+        logger.warning("Relation data warning: %s", issue)
+    logger.info("Reloaded relations (version %s): %d countries changed, %d cached maps invalidated.", graph.version, len(changed), invalidated)
+    if rewarm:
+        threading.Thread(target=warm_render_cache, args=(rewarm, False), daemon=True).start()
+    return changed
+
+@app.before_request
+def check_relations_file():
+    """Reloads the relations file if the check interval has passed and it was modified."""
+    global _relations_checked_at
+    now = time.monotonic()
+    if now - _relations_checked_at < RELATIONS_RELOAD_INTERVAL:
+        return
+    _relations_checked_at = now
+    reload_relations()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Records the latency and status of every request handled by a route."""
+    started = g.pop('request_started', None)
+    if METRICS_ENABLED and started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+        HTTP_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+_file_counts = {} # folder -> (monotonic time counted, file count)
+_file_counts_lock = threading.Lock()
+
+def count_files(folder):
+    """
+    Counts the files below a folder (0 if it does not exist). Walking a large tile cache is
+    slow, so counts are reused for METRICS_DISK_TTL seconds rather than recomputed per scrape.
+    """
+    if not folder:
+        return 0
+    # Concurrent scrapes wait for one walk instead of each walking the folder
+    with _file_counts_lock:
+        counted = _file_counts.get(folder)
+        if counted is not None and time.monotonic() - counted[0] < METRICS_DISK_TTL:
+            return counted[1]
+        count = sum(len(files) for _, _, files in os.walk(folder)) if os.path.isdir(folder) else 0
+        _file_counts[folder] = (time.monotonic(), count)
+        return count
+
+@app.route('/metrics')
+def metrics():
+    """
+    Exposes request, stage and image size histograms plus render cache, render queue and
+    disk usage figures in the Prometheus text exposition format.
+    """
+    if not METRICS_ENABLED:
+        abort(404)
+    cache = render_cache.stats()
+    service = render_service.stats()
+    lines = []
+    for histogram in (HTTP_REQUEST_SECONDS, STAGE_SECONDS, MAP_IMAGE_BYTES):
+        lines += histogram.expose()
+    lines += HTTP_REQUESTS.expose()
+    for name in ('hits', 'misses', 'evictions', 'expirations', 'invalidations'):
+        lines += metric_lines(f'geomap_render_cache_{name}_total', f'Render cache {name}.', 'counter', [({}, cache[name])])
+    lines += metric_lines('geomap_render_cache_hit_ratio', 'Share of render cache lookups that were hits.', 'gauge', [({}, cache['hit_ratio'])])
+    lines += metric_lines('geomap_render_cache_entries', 'Images held in the render cache.', 'gauge',
+                          [({"pinned": "false"}, cache['entries']), ({"pinned": "true"}, cache['pinned_entries'])])
+    lines += metric_lines('geomap_render_cache_bytes', 'Bytes of images held in the render cache.', 'gauge',
+                          [({"pinned": "false"}, cache['bytes']), ({"pinned": "true"}, cache['pinned_bytes'])])
+    lines += metric_lines('geomap_renders_in_flight', 'Renders running or queued in the render service.', 'gauge', [({}, service['in_flight'])])
+    lines += metric_lines('geomap_renders_queued', 'Renders waiting for a free render worker.', 'gauge', [({}, service['queued'])])
+    lines += metric_lines('geomap_render_jobs_total', 'Render jobs by outcome.', 'counter',
+                          [({"result": name}, service[name]) for name in ('completed', 'failed', 'rejected', 'coalesced')])
+    lines += metric_lines('geomap_files_on_disk', 'Files in the folders the app writes to.', 'gauge', [
+        ({"folder": "static"}, count_files(STATIC_FOLDER)),
+        ({"folder": "tile_cache"}, count_files(TILE_CACHE_FOLDER)),
+        ({"folder": "render_cache_shared"}, count_files(render_cache.shared_folder)),
+    ])
+    lines += metric_lines('geomap_relations_info', 'Loaded relations data version.', 'gauge', [({"version": relation_graph.version}, 1)])
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+# Relation snapshot animations. A sequence of relations datasets (e.g. one per year) is shown
+# as frames of one country's allies and enemies. Frames are split into one batch per worker
+# process; each batch builds its map once (the cached base layers in layered mode, or one
+# figure whose country facecolors are updated per frame in full mode) instead of per frame.
+ANIMATION_FRAME_DURATION = 800 # Milliseconds each frame is shown
+ANIMATION_FORMATS = {'.gif': 'GIF', '.webp': 'WEBP'}
+
+def load_relation_snapshots(paths):
+    """
+    Reads relations snapshots from JSON/CSV files, in order; a directory stands for the
+    relations files it contains, sorted by name. Returns (label, data) pairs.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith(('.json', '.csv'))))
+        else:
+            files.append(path)
+    return [(os.path.splitext(os.path.basename(path))[0], read_relations_file(path)) for path in files]
+
+def render_frame_batch(extent, frames, image_format='png'):
+    """
+    Render job: renders frames of (selected_iso, allies, enemies) at one extent, reusing one
+    map for the whole batch, and returns the encoded images in order.
+    """
+    images = []
+    layers = None
+    if RENDER_MODE == 'layered':
+        try:
+            layers = get_map_layers(extent)
         except Exception as e:
-            print(f'Failed to delete {file_path} during startup cleanup. Reason: {e}')
-    print("Static folder cleanup complete.")
-
-    # Generate the initial default map right after cleanup
-    default_map_filename = 'world_map_default.png'
-    default_map_path = os.path.join(STATIC_FOLDER, default_map_filename)
-    generate_world_map_image(default_map_path, extent=DEFAULT_EXTENT)
-    print(f"Generated initial default map at {default_map_path}")
+            logger.exception("Error building map layers, rendering frames in full: %s", e)
+
+    if layers is not None:
+        for selected_iso, allies_iso_list, enemies_iso_list in frames:
+            with timed_stage('composite'):
+                image = composite_map_image(layers, selected_iso, allies_iso_list, enemies_iso_list)
+            with timed_stage('image_encode'):
+                images.append(encode_image(image, image_format))
+        return images
+
+    with timed_stage('figure_build'):
+        fig = build_map_figure(extent)
+    isos, country_artist = fig.country_layer
+    for selected_iso, allies_iso_list, enemies_iso_list in frames:
+        if country_artist is not None:
+            allies, enemies = frozenset(allies_iso_list), frozenset(enemies_iso_list)
+            country_artist.set_facecolor([country_facecolor(iso_a3, selected_iso, allies, enemies) for iso_a3 in isos])
+        with timed_stage('rasterize'):
+            image = rasterize_figure(fig)
+        with timed_stage('image_encode'):
+            images.append(encode_image(image, image_format))
+    plt.close(fig)
+    return images
+
+def render_relation_frames(extent, frames, workers=RENDER_WORKERS):
+    """
+    Renders frames of (selected_iso, allies, enemies) across `workers` processes (inline if
+    fewer than two) and yields the encoded PNG frames in order as their batches complete.
+    """
+    extent = quantize_extent(extent)
+    if workers < 2 or len(frames) < 2:
+        yield from render_frame_batch(extent, frames)
+        return
+    batch_size = math.ceil(len(frames) / workers)
+    batches = [frames[start:start + batch_size] for start in range(0, len(frames), batch_size)]
+    # Build the base layers before forking, so every worker inherits them
+    if RENDER_MODE == 'layered':
+        get_map_layers(extent)
+    with ProcessPoolExecutor(max_workers=len(batches), mp_context=multiprocessing.get_context(RENDER_START_METHOD)) as pool:
+        for images in pool.map(render_frame_batch, [extent] * len(batches), batches):
+            yield from images
+
+def label_frame(data, label):
+    """Decodes an encoded frame and writes its snapshot label in the top left corner."""
+    image = Image.open(io.BytesIO(data)).convert('RGBA')
+    if label:
+        draw = ImageDraw.Draw(image)
+        draw.rectangle(draw.textbbox((10, 10), label), fill='white')
+        draw.text((10, 10), label, fill='black')
+    return image
+
+def write_relation_animation(snapshots, country, output, extent=DEFAULT_EXTENT, duration=ANIMATION_FRAME_DURATION,
+                             workers=RENDER_WORKERS):
+    """
+    Renders one frame per (label, data) snapshot showing country's relations, and writes them
+    to output: an animated GIF or WebP by extension, otherwise a directory of numbered PNGs.
+    Frames are streamed to the writer as they are rendered. Returns the number of frames.
+    """
+    if not snapshots:
+        return 0
+    frames = []
+    for _, data in snapshots:
+        allies, enemies = RelationGraph(data).relations(country)
+        frames.append((country, list(allies), list(enemies)))
+    labels = [label for label, _ in snapshots]
+    encoded = render_relation_frames(extent, frames, workers)
+
+    animation_format = ANIMATION_FORMATS.get(os.path.splitext(output)[1].lower())
+    if animation_format is None:
+        os.makedirs(output, exist_ok=True)
+        for index, (data, label) in enumerate(zip(encoded, labels), start=1):
+            label_frame(data, label).save(os.path.join(output, f"frame_{index:04d}.png"))
+        return len(frames)
+
+    images = (label_frame(data, label) for data, label in zip(encoded, labels))
+    first = next(images)
+    if animation_format == 'GIF':
+        # GIF has no alpha channel; the map is opaque, so convert each frame to a palette image
+        first = first.convert('RGB')
+        images = (image.convert('RGB') for image in images)
+    first.save(output, format=animation_format, save_all=True, append_images=images, duration=duration, loop=0)
+    return len(frames)
+
+@app.cli.command('render-animation')
+@click.argument('snapshots', nargs=-1, required=True)
+@click.option('--country', required=True, help='ISO code of the country whose relations are shown.')
+@click.option('--output', required=True, help='Animated .gif or .webp file, or a directory for PNG frames.')
+@click.option('--bbox', default=None, help='View as west,south,east,north (default: the whole world).')
+@click.option('--duration', default=ANIMATION_FRAME_DURATION, show_default=True, help='Milliseconds per frame.')
+@click.option('--workers', default=RENDER_WORKERS, show_default=True, help='Render processes to fan frames out to.')
+def render_animation(snapshots, country, output, bbox, duration, workers):
+    """Renders how a country's relations evolve across SNAPSHOTS (relations files or directories of them, in order)."""
+    extent = bbox_to_extent(parse_floats(bbox, 4, 'bbox')) if bbox else DEFAULT_EXTENT
+    loaded = load_relation_snapshots(snapshots)
+    if not loaded:
+        raise click.UsageError("No relations snapshots found.")
+    started = time.perf_counter()
+    count = write_relation_animation(loaded, country, output, extent, duration, workers)
+    click.echo(f"Rendered {count} frames to {output} in {time.perf_counter() - started:.1f}s")
+
+
+@app.cli.command('render-server')
+@click.option('--address', default=lambda: RENDER_SERVICE_ADDRESS or '127.0.0.1:5001', show_default='RENDER_SERVICE_ADDRESS or 127.0.0.1:5001',
+              help='host:port or Unix socket path to listen on.')
+@click.option('--workers', default=RENDER_WORKERS, show_default=True, help='Render worker processes.')
+def render_server(address, workers):
+    """Runs one render service shared by every web worker that sets RENDER_SERVICE_ADDRESS."""
+    if not RENDER_SERVICE_AUTHKEY:
+        raise click.UsageError("Set RENDER_SERVICE_AUTHKEY (the same value as the web workers).")
+    service = RenderService(max_workers=workers)
+    RenderServerManager.register('render_service', callable=lambda: service)
+    manager = RenderServerManager(address=parse_render_service_address(address), authkey=RENDER_SERVICE_AUTHKEY.encode('utf-8'))
+    click.echo(f"Render server listening on {address} with {workers} render workers")
+    manager.get_server().serve_forever()
+
+@app.cli.command('build-geometry-bundle')
+@click.option('--resolution', default='110m', show_default=True, type=click.Choice(['110m', '50m', '10m']),
+              help='Natural Earth resolution to convert.')
+@click.option('--if-missing', is_flag=True, help='Do nothing if the bundle already exists.')
+def build_geometry_bundle(resolution, if_missing):
+    """Converts the Natural Earth admin_0 countries shapefile into a geometry bundle in data/."""
+    path = geometry_bundle_path(resolution)
+    if if_missing and os.path.exists(path):
+        click.echo(f"{path} already exists")
+        return
+    countries = read_natural_earth_countries(resolution)
+    write_geometry_bundle(path, countries)
+    click.echo(f"Wrote {len(countries)} countries to {path} ({os.path.getsize(path)} bytes)")
+
+
+# Warm the render cache in the background so the worker starts serving right away
+if WARM_RENDER_CACHE:
+    threading.Thread(target=warm_render_cache, daemon=True).start()
+
+if __name__ == '__main__':
+    # Request handlers serve maps from the render cache and never write to static/; the only file
+    # kept there is the default map used as a fallback when a render fails. Create it if missing.
+    default_map_path = os.path.join(STATIC_FOLDER, 'world_map_default.png')
+    if not os.path.exists(default_map_path):
+        if generate_world_map_image(default_map_path, extent=DEFAULT_EXTENT):
+            logger.info("Generated fallback default map at %s", default_map_path)
 
     app.run(debug=True, port=5000)
@@ -0,0 +1,213 @@
+"""
+Offline benchmark and profiling suite for the map endpoints.
+
+Replays representative workloads against the Flask test client (no server or network
+needed) and reports, as JSON, latency percentiles and throughput per endpoint plus the
+time spent in each render/lookup stage recorded through app.timed_stage():
+
+    geometry_lookup  visible_countries() for the view (included in figure_build)
+    figure_build     building the matplotlib figure
+    layer_build      rendering base + label layers for a repeated extent (layered mode;
+                     includes that extent's figure_build and rasterize)
+    composite        recoloring the base layer (layered mode)
+    rasterize        drawing the figure with Agg
+    image_encode     PNG/WebP encoding
+    country_lookup   click hit testing
+    extent_math      zoom rectangle to extent conversion
+
+Usage:
+    python bench.py                                    # all workloads, report to stdout
+    python bench.py --workload random_zooms --iterations 50 --output bench.json
+    python bench.py --cold --profile bench.prof        # re-render every request, write cProfile stats
+
+The .prof file can be viewed with snakeviz or turned into a flamegraph with flameprof.
+"""
+import argparse
+import cProfile
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+# Render inline so stage timings are recorded in this process rather than in pool workers
+os.environ.setdefault('RENDER_WORKERS', '0')
+# Only warnings from the app; its logs go to stderr and never mix with the JSON report
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import numpy as np
+
+import app as geomap
+
+MAP_WIDTH_PX = 1000 # Client image size the endpoints scale clicks against
+MAP_HEIGHT_PX = 700
+
+def lonlat_to_pixel(lon, lat, extent=geomap.DEFAULT_EXTENT):
+    """Pixel of (lon, lat) on the map for extent when shown at MAP_WIDTH_PX x MAP_HEIGHT_PX."""
+    x, y = geomap.view_transform(extent).lonlat_to_pixels(lon, lat, (MAP_WIDTH_PX, MAP_HEIGHT_PX))
+    return float(x), float(y)
+
+def click_payload(x, y):
+    return {"x": x, "y": y, "img_width": MAP_WIDTH_PX, "img_height": MAP_HEIGHT_PX}
+
+def global_clicks(rng, iterations):
+    """Clicks on countries at the global extent, skewed towards a few popular countries."""
+    isos = list(geomap._country_geometries.keys())
+    popular = isos[:30]
+    requests = [('POST', '/reset_view', None)]
+    for _ in range(iterations):
+        iso = rng.choice(popular) if rng.random() < 0.8 else rng.choice(isos)
+        point = geomap._country_geometries[iso]['geometry'].representative_point()
+        requests.append(('POST', '/click_map', click_payload(*lonlat_to_pixel(point.x, point.y))))
+    return requests
+
+def random_zooms(rng, iterations):
+    """Rectangle zooms from the global view, each followed by a reset."""
+    requests = []
+    for _ in range(iterations):
+        x1, x2 = sorted(rng.uniform(0, MAP_WIDTH_PX) for _ in range(2))
+        y1, y2 = sorted(rng.uniform(0, MAP_HEIGHT_PX) for _ in range(2))
+        requests.append(('POST', '/zoom_to_rect', {"x1": x1, "y1": y1, "x2": x2, "y2": y2,
+                                                   "img_width": MAP_WIDTH_PX, "img_height": MAP_HEIGHT_PX}))
+        requests.append(('POST', '/reset_view', None))
+    return requests
+
+def ocean_clicks(rng, iterations):
+    """Clicks at the global extent that hit no country."""
+    requests = [('POST', '/reset_view', None)]
+    attempts = 0
+    while len(requests) <= iterations and attempts < iterations * 100:
+        attempts += 1
+        lon, lat = rng.uniform(-180, 180), rng.uniform(-90, 90)
+        if geomap.find_country_at(lon, lat) is None:
+            requests.append(('POST', '/click_map', click_payload(*lonlat_to_pixel(lon, lat))))
+    return requests
+
+def reset_storm(rng, iterations):
+    """Many back-to-back view resets."""
+    return [('POST', '/reset_view', None) for _ in range(iterations)]
+
+WORKLOADS = {
+    "global_clicks": global_clicks,
+    "random_zooms": random_zooms,
+    "ocean_clicks": ocean_clicks,
+    "reset_storm": reset_storm,
+}
+
+def summarize(samples):
+    """Latency summary (milliseconds) for a list of durations in seconds."""
+    values = np.array(samples) * 1000
+    total = values.sum() / 1000
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+        "throughput_rps": len(samples) / total if total else None,
+    }
+
+def clear_caches():
+    geomap.render_cache.clear()
+    with geomap._map_layers_lock:
+        geomap._map_layers.clear()
+        geomap._layer_candidates.clear()
+
+def run_workload(name, requests, cold):
+    client = geomap.app.test_client()
+    endpoint_samples = defaultdict(list)
+    stage_samples = defaultdict(list)
+    errors = 0
+
+    def record_stage(stage, seconds):
+        stage_samples[stage].append(seconds)
+
+    geomap.add_stage_listener(record_stage)
+    started = time.perf_counter()
+    try:
+        for method, path, payload in requests:
+            if cold:
+                clear_caches()
+            request_started = time.perf_counter()
+            response = client.open(path, method=method, json=payload)
+            # Zooms answer before their map is rendered; fetch it like the page does so the
+            # render is timed (and its stages recorded) as part of the zoom
+            body = response.get_json(silent=True) or {}
+            if response.status_code < 400 and body.get('status_url') and body.get('map_url'):
+                response = client.get(body['map_url'])
+            endpoint_samples[path].append(time.perf_counter() - request_started)
+            if response.status_code >= 400:
+                errors += 1
+    finally:
+        geomap.remove_stage_listener(record_stage)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(requests),
+        "errors": errors,
+        "wall_seconds": elapsed,
+        "throughput_rps": len(requests) / elapsed if elapsed else None,
+        "endpoints": {path: summarize(samples) for path, samples in endpoint_samples.items()},
+        "stages": {stage: summarize(samples) for stage, samples in stage_samples.items()},
+        "render_cache": geomap.render_cache.stats(),
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the map endpoints offline.")
+    parser.add_argument('--workload', choices=sorted(WORKLOADS) + ['all'], default='all')
+    parser.add_argument('--iterations', type=int, default=20, help='Requests per workload (default: 20).')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cold', action='store_true', help='Clear the render caches before every request.')
+    parser.add_argument('--profile', metavar='PATH', help='Write cProfile stats for the whole run to PATH.')
+    parser.add_argument('--output', metavar='PATH', help='Write the JSON report to PATH instead of stdout.')
+    args = parser.parse_args(argv)
+
+    names = sorted(WORKLOADS) if args.workload == 'all' else [args.workload]
+    rng = random.Random(args.seed)
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "render_mode": geomap.RENDER_MODE,
+            "iterations": args.iterations,
+            "seed": args.seed,
+            "cold": args.cold,
+        },
+        "workloads": {},
+    }
+
+    profiler = cProfile.Profile() if args.profile else None
+    clear_caches()
+    for name in names:
+        requests = WORKLOADS[name](rng, args.iterations)
+        if profiler:
+            profiler.enable()
+        report["workloads"][name] = run_workload(name, requests, args.cold)
+        if profiler:
+            profiler.disable()
+
+    if profiler:
+        profiler.dump_stats(args.profile)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())